@@ -2,25 +2,35 @@
 
 import numpy as np
 import grainstream as gs
+import stats as st
 from scipy.io import wavfile as wav
 import scipy.signal as sig
-import plotting as pl
+import scipy.fftpack as fftp
+from collections import OrderedDict
+import tempfile
+import struct
 import sys
+import os
 
 # ---------------
 # tukey
 # Generates a tukey (tapered cosine) window.
 # Same as the matlab definition: http://www.mathworks.co.uk/help/signal/ref/tukeywin.html
 # Taken from: http://leohart.wordpress.com/2006/01/29/hello-world/
+# start and stop return just that section of the window, so long windows can be made in chunks.
 # ---------------
-def tukey(window_length, alpha=0.5):
+def tukey(window_length, alpha=0.5, start=0, stop=None):
+    if stop == None:
+        stop = window_length
     if alpha <= 0:
-        return np.ones(window_length)
+        return np.ones(stop-start)
     elif alpha >= 1:
-        return np.hanning(window_length)
- 
-    x = np.linspace(0, 1, window_length)
-    window = np.ones(window_length)
+        alpha = 1. # the tukey window becomes a hann window
+
+    # same spacing as np.linspace(0, 1, window_length)
+    x = np.arange(start, stop) * (1./max(window_length-1, 1))
+    x[np.arange(start, stop) == window_length-1] = 1.
+    window = np.ones(stop-start)
  
     fade_in = x < alpha/2
     window[fade_in] = 0.5 * (1 + np.cos(2*np.pi/alpha * (x[fade_in] - alpha/2)))
@@ -32,103 +42,318 @@ def tukey(window_length, alpha=0.5):
 # ---------------
 # normalise
 # Normalises a mono signal (aud) so the max value only touches lev.
+# With in_place the signal itself is scaled (and returned) instead of a copy.
 # ---------------
-def normalise(aud,lev,_print=False):
+def normalise(aud,lev,_print=False,in_place=False):
     peak = np.amax(np.abs(aud))
     if _print:
         print "Peak level is %.4f, normalising to %.2f.." % (peak,lev)
+    if in_place:
+        aud *= lev/peak
+        return aud
     return aud*(lev/peak)
 
 # ---------------
 # normalise_stereo
 # Does the same as normalise but with a stereo input. Separate functions for optimisation.
 # ---------------
-def normalise_stereo(aud,lev,_print=False):
+def normalise_stereo(aud,lev,_print=False,in_place=False):
     peak = np.amax(np.abs(aud))
     if _print:
         print "Peak level is %.4f, normalising to %.2f.." % (peak,lev)
+    if in_place:
+        aud *= lev/peak
+        return [aud[0],aud[1]]
     return [aud[0]*(lev/peak),aud[1]*(lev/peak)]
 
+# ---------------
+# pan_gains
+# Returns [left gains,right gains] for an array of pan values, from -1 (left) to 1 (right).
+# The 'linear' law leaves a centred grain at full level in both channels and fades out the far
+# channel as it pans. The 'constant' (constant power) law keeps left^2+right^2 at 1 wherever the
+# grain is, so it sits 3dB lower in each channel in the centre but doesn't get louder off centre.
+# ---------------
+def pan_gains(pan,law='linear'):
+    if law == 'constant':
+        angle = (np.clip(pan,-1.,1.)+1)*(np.pi/4)
+        return [np.cos(angle),np.sin(angle)]
+    return [np.clip(1-pan,0.,1.),np.clip(1+pan,0.,1.)]
+
+# ---------------
+# mixer
+# A stereo buffer that streams are accumulated into one at a time, so mixing never needs
+# more than the output itself in memory, however many streams there are.
+# If tmp_dir is given the buffer is a memory-mapped file in that directory instead, so
+# the mix doesn't have to fit in memory at all. With shared an in-memory buffer is put in shared
+# memory, so processes forked after it's made write into the same buffer (a mapped file always is).
+# ---------------
+class mixer:
+    def __init__(self,length,tmp_dir=None,dtype=np.float32,shared=False):
+        self.length = length
+        self.dtype = np.dtype(dtype)
+        self.path = None
+        self.scratch = None
+        if tmp_dir == None and shared:
+            from multiprocessing.sharedctypes import RawArray
+            import ctypes
+            self.audio = np.frombuffer(RawArray(ctypes.c_byte,2*length*self.dtype.itemsize),dtype=self.dtype).reshape(2,length)
+        elif tmp_dir == None:
+            self.audio = np.zeros([2,length],dtype=self.dtype)
+        else:
+            fd,self.path = tempfile.mkstemp('.mix','iota',tmp_dir)
+            os.close(fd)
+            self.audio = np.memmap(self.path,dtype=self.dtype,mode='w+',shape=(2,length))
+
+    # ---------------
+    # add
+    # Pans a stream and adds it into the mix at its offset. The buffer the panned grains go
+    # through is kept for the next stream of the same shape.
+    # ---------------
+    def add(self,stream):
+        if self.scratch is None or self.scratch.shape != stream.audio.shape or self.scratch.dtype != stream.audio.dtype:
+            self.scratch = np.empty_like(stream.audio)
+        stream.mix_into(self.audio,self.scratch)
+
+    # ---------------
+    # add_mix
+    # Adds another mix (e.g. a partial mix) into this one, a chunk at a time.
+    # ---------------
+    def add_mix(self,other):
+        for i in range(0,self.length,chunk_size):
+            self.audio[:,i:i+chunk_size] += other.audio[:,i:i+chunk_size]
+
+    # ---------------
+    # clear
+    # Zeroes the mix, a chunk at a time.
+    # ---------------
+    def clear(self):
+        for i in range(0,self.length,chunk_size):
+            self.audio[:,i:i+chunk_size] = 0.
+
+    # ---------------
+    # chunks
+    # Yields the mix in chunks of chunk_size samples.
+    # ---------------
+    def chunks(self):
+        for i in range(0,self.length,chunk_size):
+            yield self.audio[:,i:i+chunk_size]
+
+    # ---------------
+    # close
+    # Releases the buffer, deleting the file behind it if there is one.
+    # ---------------
+    def close(self):
+        self.audio = None
+        self.scratch = None
+        if self.path != None:
+            os.remove(self.path)
+            self.path = None
+
 # ---------------
 # mixdown
 # Mixes any number of stereo streams together.
 # ---------------
 def mixdown(streams):
-    _streams = np.empty([len(streams)*2,streams[0].get_length()])
-    for i in range(0,len(streams)):
-        s = streams[i].get_audio()
-        _streams[i] = s[0]
-        _streams[len(streams)+i] = s[1]
-    mixed = [np.sum(_streams[0:len(streams)],0),np.sum(_streams[len(streams):len(streams)*2],0)]
-    return mixed
+    mix = mixer(streams[0].get_length(),dtype=streams[0].audio.dtype)
+    for s in streams:
+        mix.add(s)
+    return mix.audio
+
+# ---------------
+# window_stats
+# Returns the mean and the peak of the absolute amplitudes in each window of a stereo signal.
+# ---------------
+def window_stats(stereo,window_size):
+    num_windows = -(-stereo.shape[1]/window_size)
+    frames = np.zeros([2,num_windows*window_size],dtype=stereo.dtype)
+    np.abs(stereo,out=frames[:,:stereo.shape[1]])
+    frames = frames.reshape(2,num_windows,window_size)
+    means = np.sum(frames,axis=(0,2))
+    means[:-1] /= 2*window_size
+    means[-1] /= 2*(stereo.shape[1]-(num_windows-1)*window_size) # the last window can be shorter
+    return [means,np.amax(frames,axis=(0,2))]
+
+# ---------------
+# compression_knee
+# Determines the compression threshold from the means of every window: the level that
+# a certain percentage of them exceed.
+# ---------------
+def compression_knee(window_means,level):
+    wm_sorted = np.sort(window_means)
+    return wm_sorted[min(int(len(wm_sorted) - len(wm_sorted) * level),len(wm_sorted)-1)]
+
+# ---------------
+# compression_gains
+# Returns the gain the compressor applies to windows with the given means.
+# ---------------
+def compression_gains(window_means,knee,ratio):
+    gains = np.ones(len(window_means))
+    over = (window_means >= knee) & (window_means > 0.)
+    gains[over] = (knee + (window_means[over] - knee) * (1./ratio)) / window_means[over]
+    return gains
+
+# ---------------
+# envelope_gains
+# Smooths the gain reduction of every window with an attack/release envelope follower: a one-pole
+# filter that uses the attack time while the reduction is rising and the release time while it's
+# falling. The follower steps once per window rather than once per sample, so the loop is
+# window_size times shorter than the signal.
+# ---------------
+def envelope_gains(gains,window_size,params):
+    window_time = window_size/float(params.sample_rate)
+    [attack,release] = [np.exp(-window_time/max(time/1000.,window_time)) for time in [params.comp_attack,params.comp_release]]
+    smoothed = []
+    envelope = 0.
+    for reduction in (1.-gains).tolist():
+        a = attack if reduction > envelope else release
+        envelope = a*envelope + (1.-a)*reduction
+        smoothed.append(envelope)
+    return 1.-np.array(smoothed)
+
+# ---------------
+# window_gains
+# Returns the gain for every window, according to the compression mode.
+# ---------------
+def window_gains(window_means,knee,window_size,params):
+    gains = compression_gains(window_means,knee,params.comp_ratio)
+    if params.comp_mode == 'envelope':
+        gains = envelope_gains(gains,window_size,params)
+    return gains
+
+# ---------------
+# apply_gains
+# Applies window gains to a stereo signal that starts at sample start of the whole signal.
+# Plain window gains are applied with one broadcast multiply over the windows. Envelope gains
+# are interpolated between window centres so they change smoothly from sample to sample.
+# ---------------
+def apply_gains(stereo,gains,window_size,params,start=0,out=None):
+    length = stereo.shape[1]
+    first,last = start/window_size,-(-(start+length)/window_size)
+    if params.comp_mode == 'envelope':
+        first,last = max(first-1,0),min(last+1,len(gains))
+        centres = np.arange(first,last)*window_size + (window_size-1)/2.
+        return np.multiply(stereo,np.interp(np.arange(start,start+length),centres,gains[first:last]).astype(stereo.dtype),out=out)
+    # chunks start on a window boundary
+    gains = gains[first:last].astype(stereo.dtype)
+    full = length/window_size
+    compressed = out if out is not None else np.empty(stereo.shape,dtype=stereo.dtype)
+    np.multiply(stereo[:,:full*window_size].reshape(2,full,window_size),gains[:full,np.newaxis],
+        out=compressed[:,:full*window_size].reshape(2,full,window_size))
+    compressed[:,full*window_size:] = stereo[:,full*window_size:]*gains[full:]
+    return compressed
 
 # ---------------
 # compress
-# Simple dynamic range compression, no attack or release or anything but works pretty well.
+# Simple dynamic range compression.
 # Slides a window across a (stereo) signal and records the means of all the amplitudes in each frame.
 # Then determines a threshold, which is defined as a level a certain percentage of frame amplitudes exceed.
 # For example: a 'level' value of 0.2 will result in a threshold that 20% of the values exceed.
 # Then the distances between frame amplitudes exceeding the threshold, from the threshold, are reduced
-# according to the ratio.
-# ---------------
-def compress(stereo,window_size,params):
-    level,ratio = params.comp_thresh,params.comp_ratio
-    np.seterr(all='raise')
-    stereo = np.array(stereo)
-    window_means = []
-    for i in range(0,stereo.shape[1],window_size):
-            frame = np.abs(stereo[:,i:min(i+window_size,stereo.shape[1])])
-            frame_mean = np.mean(frame)
-            window_means.append(frame_mean)
-        
-    wm_sorted = np.sort(window_means)
-    wm_knee = wm_sorted[int(len(wm_sorted) - len(wm_sorted) * level)]
-    compressed = stereo
-    _ratio = 1./ratio
-    for i,m in enumerate(window_means):
-        if m >= wm_knee:
-            target_level = wm_knee + (m - wm_knee) * _ratio
-            compressed[:,i*window_size:min((i+1)*window_size,stereo.shape[1])] = stereo[:,i*window_size:min((i+1)*window_size,stereo.shape[1])] * (target_level/m)
-        
-    if params.debug>1:
-        window_means2 = []
-        for i in range(0,stereo.shape[1],window_size):
-            window_means2.append(np.mean(np.abs(compressed[:,i:min(i+window_size,stereo.shape[1])])))
-        pl.plot_dynamic_range(window_means,window_means2)
+# according to the ratio. In envelope mode the gain follows an attack/release envelope instead of
+# jumping from window to window.
+# Window gains for the whole signal can be passed in, e.g. when a long signal is compressed in chunks,
+# along with the position of the chunk. out can be the signal itself, to compress it in place.
+# ---------------
+def compress(stereo,window_size,params,gains=None,start=0,out=None):
+    stereo = np.asarray(stereo)
+    if gains is None:
+        window_means = window_stats(stereo,window_size)[0]
+        knee = compression_knee(window_means,params.comp_thresh)
+        gains = window_gains(window_means,knee,window_size,params)
+    return apply_gains(stereo,gains,window_size,params,start,out)
 
-    return compressed
+# ---------------
+# post_process_chunks
+# Post-processing procedure. Compresses, fades and normalises the mixed down audio
+# and yields it in chunks, in a format that can be written to disk.
+# A first pass over the mix collects the window stats the compressor needs, which also give
+# the peak level after plain window compression, so the second pass can do everything a chunk at
+# a time. Envelope compression changes gain within windows, so its peak takes another pass.
+# The second pass works on the mix in place, so the mix is used up afterwards.
+# ---------------
+chunk_size = 1<<18 # samples, must be a multiple of the compression window size
+def post_process_chunks(mixed,params,window_size=16,stats=None):
+    length = mixed.shape[1]
+    with st.stage(stats,'compression'):
+        means,peaks = [],[]
+        for i in range(0,length,chunk_size):
+            [_means,_peaks] = window_stats(mixed[:,i:i+chunk_size],window_size)
+            means.append(_means)
+            peaks.append(_peaks)
+        means,peaks = np.concatenate(means),np.concatenate(peaks)
+        knee = compression_knee(means,params.comp_thresh)
+        gains = window_gains(means,knee,window_size,params)
+        if params.comp_mode == 'envelope':
+            peak = max([np.amax(np.abs(compress(mixed[:,i:i+chunk_size],window_size,params,gains,i))) for i in range(0,length,chunk_size)])
+        else:
+            peak = np.amax(peaks*gains)
+    print "Peak level is %.4f, normalising to %.2f.." % (peak,params.norm_level)
+    scale = params.norm_level/peak
+    post_means = []
+    for i in range(0,length,chunk_size):
+        with st.stage(stats,'compression'):
+            chunk = mixed[:,i:i+chunk_size]
+            compress(chunk,window_size,params,gains,i,out=chunk)
+            if params.debug>1:
+                post_means.append(window_stats(chunk,window_size)[0])
+            chunk *= (32767*scale)*tukey(length,params.fade_size,i,min(i+chunk_size,length))
+            # Convert to 16 bit integer format and transpose (I work with it oriented the other way around)
+            chunk = np.transpose(chunk.astype('Int16'))
+        yield chunk
+    if params.debug>1:
+        import plotting as pl
+        pl.plot_dynamic_range(means,np.concatenate(post_means))
 
 # ---------------
 # post_process
-# Post-processing procedure. Mixes down the audio, compress, fades and normalies it
-# and outputs it in a format that can be written to disk.
+# Does all of the post-processing at once and returns the whole output. Uses up the mix, like post_process_chunks.
+# ---------------
+def post_process(mixed,params):
+    return np.concatenate(list(post_process_chunks(mixed,params)))
+
 # ---------------
-def post_process(streams,params):
-    mixed = mixdown(streams)
-    compressed = compress(mixed,16,params)
-    normalised = normalise_stereo(compressed,params.norm_level,True)
-    faded = normalised*tukey(len(normalised[0]),params.fade_size)
-    # Convert to 16 bit integer format
-    int_16 = [(faded[0]*32767).astype('Int16'),(faded[1]*32767).astype('Int16')]
-    # Transpose the matrix (I work with it oriented the other way around)
-    return np.transpose(int_16)
+# materialise
+# Converts raw source samples (any shape) to floats of the given dtype, scaled the same way as
+# read_audio does and with zeros replaced, just to prevent division by zero. Samples that are
+# already floats (e.g. a source that was converted up front) are only cast.
+# ---------------
+def materialise(raw,dtype=np.float32):
+    if raw.dtype.kind == 'f':
+        return raw.astype(dtype,copy=False)
+    samples = raw.astype(dtype)
+    samples[raw==0] = 1
+    samples /= 32767.
+    return samples
+
+# ---------------
+# wavsource
+# The first channel of a wav file, memory-mapped rather than read. Nothing is converted until
+# it's asked for: indexing returns converted floats (see materialise), and raw is the mapped
+# channel itself, for strided views that only convert the parts that are used.
+# ---------------
+class wavsource:
+    def __init__(self,filename,dtype=np.float32):
+        [self.sample_rate,data] = wav.read(filename,mmap=True)
+        self.channels = 1 if len(data.shape) == 1 else data.shape[1]
+        self.raw = data if self.channels == 1 else data[:,0]
+        self.dtype = np.dtype(dtype)
+        self.size = self.raw.shape[0]
+        self.shape = (self.size,)
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self,i):
+        return materialise(self.raw[i],self.dtype)
 
 # ---------------
 # read_audio
 # Reads a wav file and takes extracts the first channel of it, if it has more than one. 
+# The samples are scaled to floats of the given dtype.
 # ---------------
-def read_audio(filename):
-    [sample_rate,source_audio] = wav.read(filename)
-    source_audio[source_audio==0] = 1 # just to prevent division by zero
-    if len(source_audio.shape) == 1:
-        source_channels = 1
-        source_length = source_audio.shape[0]
-        source_audio_f = source_audio.astype('Float16')/32767.
-    else:
-        [source_length,source_channels] = source_audio.shape
-        source_audio_f = source_audio[:,0].astype('Float16')/32767.
-        
-    return [source_audio_f,sample_rate,source_length]
+def read_audio(filename,dtype=np.float32):
+    source = wavsource(filename,dtype)
+    return [source[:],source.sample_rate,source.size]
 
 # ---------------
 # write_audio
@@ -137,31 +362,97 @@ def read_audio(filename):
 def write_audio(filename,sample_rate,audio):
     print "Writing to %s" % filename
     wav.write(filename,sample_rate,audio)
+
+# ---------------
+# wavwriter
+# Writes a 16 bit wav file a chunk at a time. The header is written with empty sizes
+# to begin with and patched when the file is closed.
+# ---------------
+class wavwriter:
+    def __init__(self,filename,sample_rate,channels=2):
+        self.file = open(filename,'wb')
+        self.channels = channels
+        self.data_size = 0
+        self.file.write(struct.pack('<4sI4s4sIHHIIHH4sI','RIFF',0,'WAVE','fmt ',16,1,channels,sample_rate,
+            sample_rate*channels*2,channels*2,16,'data',0))
+
+    # ---------------
+    # write
+    # Appends a chunk of audio, one row per frame and one column per channel.
+    # ---------------
+    def write(self,chunk):
+        data = np.ascontiguousarray(chunk,dtype='<i2').tostring()
+        self.file.write(data)
+        self.data_size += len(data)
+
+    # ---------------
+    # close
+    # Fills in the sizes in the header and closes the file.
+    # ---------------
+    def close(self):
+        self.file.seek(4)
+        self.file.write(struct.pack('<I',36+self.data_size))
+        self.file.seek(40)
+        self.file.write(struct.pack('<I',self.data_size))
+        self.file.close()
+
+# ---------------
+# write_audio_chunks
+# Writes audio to a wav file on disk as the chunks come in.
+# ---------------
+def write_audio_chunks(filename,sample_rate,chunks,stats=None):
+    print "Writing to %s" % filename
+    writer = wavwriter(filename,sample_rate)
+    try:
+        for chunk in chunks:
+            with st.stage(stats,'write'):
+                writer.write(chunk)
+    finally:
+        with st.stage(stats,'write'):
+            writer.close()
     
 # ---------------
 # cachedfilter / filter_cache
 # Saves filter windows for each unique set of parameters, so they don't
-# need to be calculated again.
+# need to be calculated again, along with their spectra at each fft size they've been used at.
+# The cache is keyed by (mode,cutoff,transition width,attenuation,sample rate) and forgets the
+# least recently used filter once it holds filter_cache_size of them.
 # ---------------
-filter_cache = []
+filter_cache = OrderedDict()
+filter_cache_size = 64
 class cachedfilter:
-    def __init__(self,type,cutoff,trans,attenuation,filter):
-        self.type = type
-        self.cutoff = cutoff
-        self.trans = trans
-        self.attenuation = attenuation
+    def __init__(self,filter):
         self.filter = filter
+        self.num_taps = len(filter)
+        self.spectra = {}
+
+    # ---------------
+    # spectrum
+    # Returns the spectrum of the filter at fft size n.
+    # ---------------
+    def spectrum(self,n):
+        if not n in self.spectra:
+            self.spectra[n] = np.fft.rfft(self.filter,n)
+        return self.spectra[n]
+
+    # ---------------
+    # use_fft
+    # A rough cost model: direct convolution of a length signal costs length*taps multiplies,
+    # fft convolution costs a forward and an inverse transform of the padded length.
+    # ---------------
+    def use_fft(self,length):
+        n = fftp.next_fast_len(length+self.num_taps-1)
+        return 4*n*np.log2(n) < length*self.num_taps
 
 # ---------------
-# filter_audio
-# Applies a lowpass or highpass filter to a given audio segment.
-# First checks to see if the filter is in the cache and calculates it if it isn't,
-# then convolves it with the signal.
+# get_filter
+# Returns the cached filter for a set of parameters, designing it if it isn't in the cache.
 # ---------------
-def filter_audio(audio,sr=44100,mode="lowpass",cutoff=4000.0,trans_width=500.0,attenuation=60.0):
-    global filter_cache
-    cached_filter = [fc for fc in filter_cache if fc.type == mode and fc.cutoff == cutoff and fc.trans == trans_width and fc.attenuation == attenuation]
-    if len(cached_filter) == 0:
+def get_filter(sr,mode,cutoff,trans_width,attenuation):
+    key = (mode,cutoff,trans_width,attenuation,sr)
+    if key in filter_cache:
+        cf = filter_cache.pop(key)
+    else:
         nyquist = sr/2.
         width = trans_width/nyquist
         num_taps, beta = sig.kaiserord(attenuation,width)
@@ -169,11 +460,44 @@ def filter_audio(audio,sr=44100,mode="lowpass",cutoff=4000.0,trans_width=500.0,a
         if mode == "highpass":
             filter = -filter
             filter[num_taps/2] += 1
-        cf = cachedfilter(mode,cutoff,trans_width,attenuation,filter)
-        filter_cache.append(cf)
-    else:
-        filter = cached_filter[0].filter
-    convolved = np.convolve(audio,filter,"same")
-    if len(convolved) > len(audio): # this doesn't seem like it should ever happen, but sometimes it does
+        cf = cachedfilter(filter)
+        if len(filter_cache) >= filter_cache_size:
+            filter_cache.popitem(last=False)
+    filter_cache[key] = cf
+    return cf
+
+# ---------------
+# filter_audio
+# Applies a lowpass or highpass filter to a given audio segment.
+# Gets the filter from the cache, then convolves it with the signal, directly or
+# with an fft depending on which should be cheaper.
+# ---------------
+def filter_audio(audio,sr=44100,mode="lowpass",cutoff=4000.0,trans_width=500.0,attenuation=60.0):
+    cf = get_filter(sr,mode,cutoff,trans_width,attenuation)
+    if cf.use_fft(len(audio)):
+        return filter_batch(audio[np.newaxis],sr,mode,cutoff,trans_width,attenuation)[0]
+    convolved = np.convolve(audio,cf.filter,"same")
+    if len(convolved) > len(audio): # happens when the filter is longer than the audio
         convolved = convolved[:len(audio)]
-    return convolved
\ No newline at end of file
+    return convolved
+
+# ---------------
+# filter_batch
+# Applies the same filter to every row of a matrix of audio segments, e.g. a batch of grains.
+# Rows are convolved with one multi-row fft against the cached filter spectrum, or directly
+# if the cost model says that's cheaper. Gives the same result as filter_audio on each row.
+# ---------------
+def filter_batch(audio,sr=44100,mode="lowpass",cutoff=4000.0,trans_width=500.0,attenuation=60.0):
+    cf = get_filter(sr,mode,cutoff,trans_width,attenuation)
+    length = audio.shape[1]
+    if not cf.use_fft(length):
+        return np.array([filter_audio(a,sr,mode,cutoff,trans_width,attenuation) for a in audio])
+    n = fftp.next_fast_len(length+cf.num_taps-1)
+    start = (min(length,cf.num_taps)-1)/2 # where np.convolve's "same" output starts
+    spectrum = cf.spectrum(n)
+    filtered = np.empty(audio.shape)
+    batch_size = max(1,(1<<22)/n)
+    for i in range(0,audio.shape[0],batch_size):
+        convolved = np.fft.irfft(np.fft.rfft(audio[i:i+batch_size],n,axis=1)*spectrum,n,axis=1)
+        filtered[i:i+batch_size] = convolved[:,start:start+length]
+    return filtered
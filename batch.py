@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+
+#===============================================================================
+# IOTA batch renderer
+# ---------------
+# Renders every job in a manifest, one job per line in the same form as the iota.py
+# command line, e.g.
+#   -i source.wav -o out1.wav -m loop -x lp a 0.3
+#   -i source.wav -o out2.wav -m block -b a 0 5 0.5 b 3 9 0.5
+# Blank lines and lines starting with # are skipped.
+#===============================================================================
+
+import multiprocessing as mp
+import argparse as ap
+import shlex
+import json
+import time
+import sys
+
+import interface
+import engine as en
+
+# ---------------
+# read_manifest
+# Returns the argument list of every job in a manifest file, along with its line number.
+# ---------------
+def read_manifest(filename):
+    jobs = []
+    with open(filename) as f:
+        for n,line in enumerate(f):
+            line = line.strip()
+            if line == "" or line.startswith("#"):
+                continue
+            jobs.append([n+1,shlex.split(line)])
+    return jobs
+
+# ---------------
+# parse_job
+# Parses one job's arguments, returning None instead of quitting if they're invalid
+# (parser_error has already printed why).
+# ---------------
+def parse_job(argv):
+    try:
+        return interface.parse_args(argv)
+    except SystemExit:
+        return None
+
+# ---------------
+# job_source
+# What a job renders from: its corpus if it has one, otherwise its input file.
+# ---------------
+def job_source(params):
+    return params.corpus if params.corpus != None else params.infile
+
+# ---------------
+# group_jobs
+# Groups jobs by source file and analysis settings, so each group only needs analysing once.
+# Jobs rendering from a corpus are grouped by corpus alone, as a corpus is already analysed.
+# Groups keep the order their first job appears in the manifest.
+# ---------------
+def group_jobs(jobs):
+    groups = []
+    keys = []
+    for job in jobs:
+        params = job['params']
+        if params.corpus != None:
+            key = ('corpus',params.corpus)
+        else:
+            key = ('infile',params.infile,en.analysis_settings(params))
+        if not key in keys:
+            keys.append(key)
+            groups.append([])
+        groups[keys.index(key)].append(job)
+    return groups
+
+# ---------------
+# render_job
+# Renders one job with an engine that already holds its analysis, and returns its summary.
+# Failures are reported in the summary rather than stopping the batch.
+# ---------------
+def render_job(_engine,job):
+    summary = {'line':job['line'],'args':job['args'],'outfile':job['params'].outfile}
+    start = time.time()
+    try:
+        _engine.render(job['params'])
+        summary['status'] = 'ok'
+        summary['stats'] = _engine.stats.summary()
+    except Exception as e:
+        summary['status'] = 'error'
+        summary['error'] = "%s: %s" % (type(e).__name__,e)
+    summary['seconds'] = time.time()-start
+    return summary
+
+# ---------------
+# _render_job
+# Pool task: render_job with the engine inherited from the parent process.
+# ---------------
+_engine = None
+def _render_job(job):
+    return render_job(_engine,job)
+
+# ---------------
+# run_batch
+# Renders every job in a manifest and returns a summary for each, in manifest order.
+# Each group of jobs sharing a source and analysis settings is analysed once in this process,
+# and its jobs are then rendered across a pool of workers that inherit the analysis when
+# the pool is created. Only one group's analysis is held at a time.
+# ---------------
+def run_batch(jobs,workers=1):
+    global _engine
+    summaries = []
+    parsed = []
+    for line,argv in jobs:
+        params = parse_job(argv)
+        if params == None:
+            summaries.append({'line':line,'args':argv,'status':'error','error':'invalid arguments'})
+            continue
+        if workers > 1:
+            params.workers = 1 # pool workers can't have pools of their own
+        parsed.append({'line':line,'args':argv,'params':params})
+
+    for group in group_jobs(parsed):
+        print "Analysing %s for %d job(s).." % (job_source(group[0]['params']),len(group))
+        _engine = en.engine()
+        try:
+            # parsed again so the analysis starts from the same random state as iota.py would give the first job
+            _engine.analyse(parse_job(group[0]['args']))
+        except Exception as e:
+            for job in group:
+                summaries.append({'line':job['line'],'args':job['args'],'outfile':job['params'].outfile,
+                    'status':'error','error':"%s: %s" % (type(e).__name__,e)})
+            continue
+        if workers <= 1 or len(group) == 1:
+            summaries.extend([render_job(_engine,job) for job in group])
+        else:
+            pool = mp.Pool(min(workers,len(group)))
+            try:
+                summaries.extend(pool.map(_render_job,group,1))
+            finally:
+                pool.terminate()
+        _engine = None
+    return sorted(summaries,key=lambda s: s['line'])
+
+if __name__ == '__main__':
+    parser = ap.ArgumentParser(formatter_class=ap.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("manifest",help="File with one job per line, each in the form of the iota.py arguments")
+    parser.add_argument("-w","--workers",type=int,default=1,help="Number of processes to render jobs with")
+    parser.add_argument("--summary",help="File to write the summary of every job to, as JSON")
+    args = parser.parse_args()
+    if args.workers < 1:
+        interface.parser_error("Number of workers must be at least 1")
+
+    summaries = run_batch(read_manifest(args.manifest),args.workers)
+    failed = len([s for s in summaries if s['status'] != 'ok'])
+    print "Batch summary:"
+    for s in summaries:
+        if s['status'] == 'ok':
+            print "  line %d: %s in %.2fs" % (s['line'],s['outfile'],s['seconds'])
+        else:
+            print "  line %d: failed, %s" % (s['line'],s['error'])
+    print "%d of %d job(s) rendered.." % (len(summaries)-failed,len(summaries))
+    if args.summary != None:
+        with open(args.summary,'w') as f:
+            json.dump(summaries,f,indent=2)
+    sys.exit(1 if failed > 0 else 0)
@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+
+#===============================================================================
+# Benchmarks for the iota engine
+# ---------------
+# run      times every stage of the pipeline on synthetic sources and writes the results as JSON
+# compare  compares two result files and flags cases that got slower
+# cluster  compares the clustering backends on synthetic features
+#===============================================================================
+
+import numpy as np
+import argparse as ap
+from contextlib import contextmanager
+import platform
+import json
+import time
+import sys
+import os
+
+import interface
+import stats as st
+
+# ---------------
+# synthetic_source
+# Makes a deterministic test source: a few drifting tones with decaying noise bursts
+# every so often, so the events have spectra and zero-crossing rates that differ.
+# Scaled and typed like the output of audio.read_audio.
+# ---------------
+def synthetic_source(seconds,sample_rate,seed=0,dtype=np.float32):
+    rng = np.random.RandomState(seed)
+    n = int(seconds*sample_rate)
+    t = np.arange(0,n)/float(sample_rate)
+    source = np.zeros(n)
+    for f in [110.,440.,1760.,5000.]:
+        drift = 1.+0.05*np.sin(2*np.pi*rng.rand()*0.5*t)
+        source += np.sin(2*np.pi*f*drift*t)*rng.rand()
+    burst = int(0.25*sample_rate)
+    for start in range(0,n-burst,int(0.7*sample_rate)):
+        source[start:start+burst] += rng.normal(0.,1.,burst)*np.exp(-np.arange(0,burst)/(0.05*sample_rate))
+    source = 0.9*source/np.amax(np.abs(source))
+    source[source==0] = 1./32767 # like read_audio
+    return source.astype(dtype)
+
+# ---------------
+# make_params
+# Builds parameters as the command line would, then fills in the sample-rate dependent ones.
+# ---------------
+def make_params(sample_rate,args=[]):
+    with quiet():
+        params = interface.parse_args(["-i","synthetic","-o","none","--seed","1"]+args)
+    params.sample_rate = sample_rate
+    params.grain_size = (sample_rate*params.grain_size_ms)/1000
+    params.grain_spacing = (sample_rate*params.grain_spacing_ms)/1000
+    return params
+
+# ---------------
+# quiet
+# Swallows everything printed inside it, the engine is quite chatty.
+# ---------------
+@contextmanager
+def quiet():
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull,'w')
+    try:
+        yield
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+# ---------------
+# best_time
+# Runs f repeats times and returns the fastest wall time, which is the least noisy figure.
+# ---------------
+def best_time(f,repeats):
+    times = []
+    for r in range(0,repeats):
+        start = time.time()
+        with quiet():
+            f()
+        times.append(time.time()-start)
+    return min(times)
+
+# ---------------
+# analysis_cases
+# Cases for the analysis stages on one source.
+# ---------------
+def analysis_cases(seconds,sample_rate):
+    import grouping as grp
+    source = synthetic_source(seconds,sample_rate)
+    params = make_params(sample_rate)
+    spacing,grain_size = params.grain_spacing,params.grain_size
+    events = grp.select_events(source,spacing,grain_size)
+    plane = grp.analysisplane(source,sample_rate,spacing,spacing)
+    frame_idx = plane.frame_index(events)
+    with quiet():
+        features = grp.spectral_features(plane,frame_idx,params.num_features,16)
+    tag = "%gs@%d" % (seconds,sample_rate)
+    return [("select_events/%s" % tag,lambda: grp.select_events(source,spacing,grain_size)),
+        ("analysisplane/%s" % tag,lambda: grp.analysisplane(source,sample_rate,spacing,spacing)),
+        ("spectral_features/%s" % tag,lambda: grp.spectral_features(plane,frame_idx,params.num_features,16)),
+        ("zero_crossings/%s" % tag,lambda: grp.zero_crossings(plane,frame_idx)),
+        ("cluster/%s" % tag,lambda: grp.cluster(features,params.num_groups,params.cluster_iterations)),
+        ("group_events/%s" % tag,lambda: grp.group_events(source,sample_rate,params))]
+
+# ---------------
+# generator_cases
+# Cases for the generators, sweeping stream counts, grain sizes and effect density.
+# ---------------
+def generator_cases(seconds,sample_rate,streams,grain_sizes,densities):
+    import grouping as grp
+    import generator as gen
+    source = synthetic_source(seconds,sample_rate)
+    cases = []
+    def case(name,args,generator=gen.group_loop):
+        params = make_params(sample_rate,args)
+        with quiet():
+            [bank,event_list,event_groups,features] = grp.group_events(source,sample_rate,params)
+        def run():
+            mix = generator(sample_rate,params,bank,features,st.stats())
+            mix.close()
+        return (name,run)
+    for s in streams:
+        cases.append(case("group_loop/streams=%d" % s,["-s",str(s)]))
+        cases.append(case("block_generator/streams=%d" % s,["-s",str(s),"-m","block","-b","a","0","4","0.5","b","2","6","0.5"],gen.block_generator))
+    for d in [1000,10000]:
+        cases.append(case("cloud/density=%d" % d,["-m","cloud","--density",str(d),"--duration","4"],gen.cloud_generator))
+    for g in grain_sizes:
+        cases.append(case("group_loop/grainsize=%dms" % g,["-s","20","-g",str(g)]))
+    for d in densities:
+        fx = [] if d == 0. else ["-x","lp","a",str(d),"hp","b",str(d),"cv","c",str(d)]
+        cases.append(case("group_loop/effects=%g" % d,["-s","20"]+fx))
+    return cases
+
+# ---------------
+# audio_cases
+# Cases for mixing, compression and filtering.
+# ---------------
+def audio_cases(sample_rate,num_streams,seconds):
+    import audio as au
+    import grainstream as gs
+    params = make_params(sample_rate)
+    grain_size = params.grain_size
+    num_grains = int(seconds*sample_rate)/grain_size
+    rng = np.random.RandomState(0)
+    streams = []
+    for j in range(0,num_streams):
+        stream = gs.grainstream((grain_size/num_streams)*j,grain_size,num_grains,sample_rate,rng.uniform(-1.,1.,[num_grains,grain_size]).astype(np.float32),rng)
+        stream.fill(num_grains,st.stats())
+        streams.append(stream)
+    mixed = au.mixdown(streams)
+    envelope = make_params(sample_rate,["--compmode","envelope"])
+    signal = rng.uniform(-1.,1.,sample_rate)
+    grains = rng.uniform(-1.,1.,[1000,grain_size])
+    return [("mixdown/streams=%d" % num_streams,lambda: au.mixdown(streams)),
+        ("compress/window",lambda: au.compress(mixed,16,params)),
+        ("compress/envelope",lambda: au.compress(mixed,16,envelope)),
+        ("post_process",lambda: au.post_process(mixed.copy(),params)), # post_process uses up the mix
+        ("filter_audio/1s",lambda: au.filter_audio(signal,sample_rate,"lowpass",4000.,500.,60.)),
+        ("filter_audio/grain",lambda: au.filter_audio(grains[0],sample_rate,"lowpass",4000.,500.,60.)),
+        ("filter_batch/1000grains",lambda: au.filter_batch(grains,sample_rate,"lowpass",4000.,500.,60.))]
+
+# ---------------
+# run_suite
+# Times every case and returns the results, along with enough about the machine to know
+# whether two result files are comparable.
+# ---------------
+def run_suite(quick=False,repeats=3,match=None):
+    lengths = [10.] if quick else [10.,60.]
+    rates = [44100] if quick else [22050,44100]
+    streams = [10,50] if quick else [10,50,100]
+    grain_sizes = [20] if quick else [10,20,50]
+    densities = [0.,0.5] if quick else [0.,0.2,0.5,0.9]
+    cases = []
+    for seconds in lengths:
+        for rate in rates:
+            cases += analysis_cases(seconds,rate)
+    cases += generator_cases(10.,44100,streams,grain_sizes,densities)
+    cases += audio_cases(44100,streams[-1],10.)
+    results = {}
+    for name,f in cases:
+        if match != None and not match in name:
+            continue
+        results[name] = {'seconds':best_time(f,repeats),'repeats':repeats}
+        print "%-40s %9.4fs" % (name,results[name]['seconds'])
+    return {'meta':{'python':platform.python_version(),'numpy':np.__version__,'machine':platform.machine(),
+        'node':platform.node(),'time':time.strftime('%Y-%m-%d %H:%M:%S'),'quick':quick},'results':results}
+
+# ---------------
+# compare
+# Compares two result files. A case is a regression when it is more than threshold
+# (a fraction) slower than the baseline. Returns the names of the regressed cases.
+# ---------------
+def compare(baseline,current,threshold=0.1):
+    regressions = []
+    for name in sorted(current['results']):
+        if not name in baseline['results']:
+            print "%-40s %9s %9.4fs  new" % (name,"",current['results'][name]['seconds'])
+            continue
+        before,after = baseline['results'][name]['seconds'],current['results'][name]['seconds']
+        ratio = after/before if before > 0. else 1.
+        flag = ""
+        if ratio > 1.+threshold:
+            flag = "REGRESSION"
+            regressions.append(name)
+        elif ratio < 1./(1.+threshold):
+            flag = "faster"
+        print "%-40s %9.4fs %9.4fs %6.2fx  %s" % (name,before,after,ratio,flag)
+    return regressions
+
+# ---------------
+# synthetic_features
+# Makes a feature matrix (one column per event) of n_events drawn around n_groups random centres,
+# along with the group each event was drawn from. Normalised like the real features.
+# ---------------
+def synthetic_features(n_events,n_features,n_groups,rng):
+    centres = rng.rand(n_groups,n_features)
+    truth = rng.randint(0,n_groups,n_events)
+    _features = centres[truth].T + rng.normal(0.,0.08,(n_features,n_events))
+    return [np.abs(_features)/np.amax(np.abs(_features)),truth]
+
+# ---------------
+# inertia
+# Sum of squared distances from every event to its centroid.
+# ---------------
+def inertia(_features,centroids,labels):
+    return np.sum((_features-centroids[labels].T)**2)
+
+# ---------------
+# adjusted_rand
+# Adjusted Rand index between two labellings: 1 when they group events identically,
+# around 0 when they agree no better than chance.
+# ---------------
+def adjusted_rand(a,b):
+    pairs = lambda x: np.sum(x*(x-1.))/2.
+    contingency = np.zeros((np.amax(a)+1,np.amax(b)+1))
+    np.add.at(contingency,(a,b),1)
+    index = pairs(contingency)
+    rows,cols,total = pairs(np.sum(contingency,axis=1)),pairs(np.sum(contingency,axis=0)),pairs(np.array([len(a)]))
+    expected = rows*cols/total
+    return (index-expected)/((rows+cols)/2.-expected)
+
+# ---------------
+# bench_cluster
+# Clusters the same synthetic features with each backend and reports time, inertia and
+# agreement with the groups the features were drawn from.
+# ---------------
+def bench_cluster(n_events,n_features,n_groups,seed=0):
+    import grouping as grp
+    rng = np.random.RandomState(seed)
+    [_features,truth] = synthetic_features(n_events,n_features,n_groups,rng)
+    results = {}
+    for backend in ['kmeans2','minibatch']:
+        np.random.seed(seed)
+        start = time.time()
+        [centroids,labels] = grp.cluster(_features,n_groups,30,backend,seed=seed)
+        results[backend] = {'seconds':time.time()-start,'inertia':inertia(_features,centroids,labels),
+            'ari':adjusted_rand(truth,labels)}
+    return results
+
+if __name__ == '__main__':
+    parser = ap.ArgumentParser(formatter_class=ap.ArgumentDefaultsHelpFormatter)
+    commands = parser.add_subparsers(dest="command")
+    run = commands.add_parser("run",help="Time every stage and write the results as JSON")
+    run.add_argument("-o","--outfile",help="File to write the results to")
+    run.add_argument("-q","--quick",action="store_true",help="Fewer, smaller cases")
+    run.add_argument("-r","--repeats",type=int,default=3,help="Times each case is run, the fastest counts")
+    run.add_argument("-k","--match",help="Only run cases whose name contains this")
+    comp = commands.add_parser("compare",help="Compare two result files and flag regressions")
+    comp.add_argument("baseline",help="Results to compare against")
+    comp.add_argument("current",help="New results")
+    comp.add_argument("-t","--threshold",type=float,default=0.1,help="Slowdown (as a fraction) that counts as a regression")
+    clus = commands.add_parser("cluster",help="Compare the clustering backends")
+    clus.add_argument("-n","--events",type=int,default=200000,help="Number of synthetic events")
+    clus.add_argument("-f","--numfeatures",type=int,default=8,help="Number of features per event")
+    clus.add_argument("-r","--numgroups",type=int,default=5,help="Number of groups")
+    clus.add_argument("--seed",type=int,default=0,help="Random seed")
+    args = parser.parse_args()
+
+    if args.command == "run":
+        if args.repeats < 1:
+            interface.parser_error("Number of repeats must be at least 1")
+        results = run_suite(args.quick,args.repeats,args.match)
+        if args.outfile != None:
+            with open(args.outfile,'w') as f:
+                json.dump(results,f,indent=2,sort_keys=True)
+    elif args.command == "compare":
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        with open(args.current) as f:
+            current = json.load(f)
+        if baseline['meta'].get('node') != current['meta'].get('node'):
+            print "Warning: results are from different machines (%s, %s).." % (baseline['meta'].get('node'),current['meta'].get('node'))
+        regressions = compare(baseline,current,args.threshold)
+        print "%d regression(s).." % len(regressions)
+        sys.exit(1 if len(regressions) > 0 else 0)
+    elif args.command == "cluster":
+        results = bench_cluster(args.events,args.numfeatures,args.numgroups,args.seed)
+        for backend in sorted(results):
+            r = results[backend]
+            print "%-10s %8.3fs  inertia %.2f  ARI %.4f" % (backend,r['seconds'],r['inertia'],r['ari'])
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+
+import numpy as np
+import hashlib
+import shutil
+import os
+
+CACHE_VERSION = 2 # bump whenever the analysis changes in a way that invalidates old entries
+entry_files = ['events','features','centroids','labels','feature_bins','feature_scales']
+
+# ---------------
+# analysis_key
+# Hashes the source audio together with every parameter that affects the analysis,
+# so that an entry is only ever reused for exactly the same source and settings.
+# The feature bins and the clustering are drawn from the random state --seed sets, so a seeded
+# analysis is only reused for the same seed. Unseeded analyses are interchangeable.
+# ---------------
+def analysis_key(audio,sample_rate,params):
+    h = hashlib.sha1()
+    h.update("iota-analysis-%d|%d|%s|%d|%d|%d|%d|%d|%d|%s|%d|%d|%s|" % (CACHE_VERSION,sample_rate,audio.dtype.str,params.grain_size,
+        params.grain_spacing,params.num_features,params.num_groups,params.dzc,params.onsets,params.clusterer,
+        params.cluster_iterations,params.cluster_batch,'' if params.seed == None else params.seed))
+    chunk = 1<<22
+    for i in range(0,audio.size,chunk):
+        h.update(np.ascontiguousarray(audio[i:i+chunk]))
+    return h.hexdigest()
+
+# ---------------
+# load
+# Returns [event_list,features,centroids,event_groups,feature_bins,feature_scales] for a key, or None if it isn't cached.
+# Arrays are memory-mapped rather than read, and the entry is marked as recently used.
+# ---------------
+def load(cache_dir,key):
+    path = os.path.join(cache_dir,key)
+    if not os.path.isdir(path):
+        return None
+    try:
+        entry = [np.load(os.path.join(path,f+'.npy'),mmap_mode='r') for f in entry_files]
+    except (IOError,ValueError):
+        shutil.rmtree(path,True) # incomplete or corrupt entry
+        return None
+    os.utime(path,None)
+    return entry
+
+# ---------------
+# store
+# Writes an entry to the cache and then evicts old entries if it has grown beyond max_bytes.
+# The entry is written to a temporary directory first so readers never see half of one.
+# ---------------
+def store(cache_dir,key,event_list,features,centroids,event_groups,feature_bins,feature_scales,max_bytes):
+    path = os.path.join(cache_dir,key)
+    tmp_path = "%s.tmp%d" % (path,os.getpid())
+    if not os.path.isdir(tmp_path):
+        os.makedirs(tmp_path)
+    arrays = [np.asarray(event_list,dtype=int),features,centroids,event_groups,feature_bins,feature_scales]
+    for f,a in zip(entry_files,arrays):
+        np.save(os.path.join(tmp_path,f+'.npy'),np.ascontiguousarray(a))
+    try:
+        os.rename(tmp_path,path)
+    except OSError: # another process got there first
+        shutil.rmtree(tmp_path,True)
+    evict(cache_dir,max_bytes,key)
+
+# ---------------
+# evict
+# Removes the least recently used entries until the whole cache fits in max_bytes.
+# The entry named by keep is never removed.
+# ---------------
+def evict(cache_dir,max_bytes,keep=None):
+    entries = []
+    total = 0
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir,name)
+        if not os.path.isdir(path) or '.tmp' in name:
+            continue
+        size = sum([os.path.getsize(os.path.join(path,f)) for f in os.listdir(path)])
+        entries.append((os.path.getmtime(path),size,name))
+        total += size
+    for mtime,size,name in sorted(entries):
+        if total <= max_bytes:
+            break
+        if name != keep:
+            shutil.rmtree(os.path.join(cache_dir,name),True)
+            total -= size
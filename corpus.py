@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+
+#===============================================================================
+# IOTA grain corpus
+# ---------------
+# Analyses any number of wav files into one grain corpus on disk, which iota.py can then
+# render from with --corpus instead of analysing an --infile, e.g.
+#   corpus.py mycorpus --sources a.wav b.wav c.wav -g 20 -c 100 -r 8
+# Any analysis option of iota.py can be given after the sources.
+# A corpus is a directory holding:
+#   grains.npy        every grain's samples, one row per grain, unwindowed
+#   features.npy      the feature matrix, one column per grain
+#   labels.npy        the group of every grain
+#   centroids.npy     the group centroids
+#   source_index.npy  which source every grain came from
+#   source_offset.npy where in its source every grain starts, in samples
+#   meta.json         the analysis settings, feature bins and scales (one per feature), and the list of sources
+# The arrays are memory-mapped when a corpus is loaded, so loading is quick whatever its
+# size and render processes using the same corpus share its pages.
+#===============================================================================
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+import argparse as ap
+import shutil
+import json
+import os
+
+import interface
+
+CORPUS_VERSION = 1
+array_files = ['grains','features','labels','centroids','source_index','source_offset']
+
+# ---------------
+# build
+# Analyses every source with the same feature bins, normalises the features across all of them,
+# clusters all the grains together and writes the corpus to path. Sources must share a sample rate.
+# The grains are copied into the store one source at a time, so only one source is read at once.
+# ---------------
+def build(path,sources,params):
+    import audio as au
+    import grouping as grp
+    feature_bins = None
+    events,spectral,frequencies,provenance = [],[],[],[]
+    sample_rate = None
+    for n,filename in enumerate(sources):
+        print "Analysing %s (%d/%d).." % (filename,n+1,len(sources))
+        source = au.wavsource(filename,params.dtype)
+        if sample_rate == None:
+            sample_rate = source.sample_rate
+            params.sample_rate = sample_rate
+            params.grain_size = (sample_rate*params.grain_size_ms)/1000
+            params.grain_spacing = (sample_rate*params.grain_spacing_ms)/1000
+        elif source.sample_rate != sample_rate:
+            raise ValueError("%s has a sample rate of %d, the corpus is %d" % (filename,source.sample_rate,sample_rate))
+        [_events,_spectral,_frequencies,feature_bins] = grp.event_features(source,sample_rate,params,feature_bins)
+        events.append(np.asarray(_events,dtype=np.int64))
+        spectral.append(_spectral)
+        frequencies.append(_frequencies)
+        provenance.append({'path':os.path.abspath(filename),'length':source.size,'channels':source.channels,'num_grains':len(_events)})
+
+    num_grains = sum([len(e) for e in events])
+    if num_grains == 0:
+        raise ValueError("No grains found in any source")
+    spectral = np.concatenate(spectral,axis=1)
+    frequencies = None if params.dzc else np.concatenate(frequencies,axis=1)
+    scales = grp.feature_scales(spectral,frequencies)
+    features = au.normalise(spectral,1.0,in_place=True)
+    if frequencies is not None:
+        features = np.concatenate((au.normalise(frequencies,1.0),features))
+    [centroids,labels] = grp.cluster(features,params.num_groups,params.cluster_iterations,params.clusterer,params.cluster_batch,seed=params.seed)
+
+    tmp_path = "%s.tmp%d" % (path.rstrip(os.sep),os.getpid())
+    os.makedirs(tmp_path)
+    try:
+        print "Writing %d grains.." % num_grains
+        grains = np.lib.format.open_memmap(os.path.join(tmp_path,'grains.npy'),mode='w+',dtype=params.dtype,shape=(num_grains,params.grain_size))
+        first = 0
+        for filename,_events in zip(sources,events):
+            source = au.wavsource(filename,params.dtype)
+            step = source.raw.strides[0]
+            frames = as_strided(source.raw,shape=(source.size-params.grain_size+1,params.grain_size),strides=(step,step))
+            for i in range(0,len(_events),4096):
+                grains[first+i:first+i+len(_events[i:i+4096])] = au.materialise(frames[_events[i:i+4096]],params.dtype)
+            first += len(_events)
+        grains.flush()
+        del grains
+        np.save(os.path.join(tmp_path,'features.npy'),features)
+        np.save(os.path.join(tmp_path,'labels.npy'),np.asarray(labels,dtype=np.int32))
+        np.save(os.path.join(tmp_path,'centroids.npy'),centroids)
+        np.save(os.path.join(tmp_path,'source_index.npy'),np.repeat(np.arange(len(sources),dtype=np.int32),[len(e) for e in events]))
+        np.save(os.path.join(tmp_path,'source_offset.npy'),np.concatenate(events))
+        meta = {'version':CORPUS_VERSION,'sample_rate':sample_rate,'grain_size':params.grain_size,
+            'grain_size_ms':params.grain_size_ms,'grain_spacing_ms':params.grain_spacing_ms,
+            'num_groups':params.num_groups,'num_features':features.shape[0],'dzc':params.dzc,'onsets':params.onsets,
+            'dtype':np.dtype(params.dtype).name,'feature_bins':[int(b) for b in feature_bins],'feature_scales':scales.tolist(),
+            'sources':provenance}
+        with open(os.path.join(tmp_path,'meta.json'),'w') as f:
+            json.dump(meta,f,indent=2)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        os.rename(tmp_path,path)
+    except:
+        shutil.rmtree(tmp_path,True)
+        raise
+    print "Corpus of %d grains in %d groups written to %s.." % (num_grains,params.num_groups,path)
+
+# ---------------
+# corpus
+# A corpus loaded from disk, with every array memory-mapped.
+# ---------------
+class corpus:
+    def __init__(self,path):
+        with open(os.path.join(path,'meta.json')) as f:
+            self.meta = json.load(f)
+        if self.meta['version'] != CORPUS_VERSION:
+            raise ValueError("%s is a version %d corpus, this version of iota reads version %d" % (path,self.meta['version'],CORPUS_VERSION))
+        self.path = path
+        for name in array_files:
+            setattr(self,name,np.load(os.path.join(path,name+'.npy'),mmap_mode='r'))
+        self.sample_rate = self.meta['sample_rate']
+        self.grain_size = self.meta['grain_size']
+        self.num_groups = self.meta['num_groups']
+        self.sources = [s['path'] for s in self.meta['sources']]
+
+    # ---------------
+    # bank
+    # A grain bank drawing straight from the grain store: every grain is a row of the store, so
+    # the bank's source is the flattened store and the grain offsets are multiples of the grain size.
+    # ---------------
+    def bank(self):
+        import grainstream as gs
+        offsets = np.arange(0,self.grains.shape[0])*self.grain_size
+        bank = gs.grainbank(self.grains.reshape(-1),offsets,self.labels,self.features,self.grain_size,self.num_groups)
+        bank.feature_bins,bank.feature_scales = np.asarray(self.meta['feature_bins']),np.asarray(self.meta['feature_scales'])
+        return bank
+
+    # ---------------
+    # provenance
+    # Returns [source path,offset in samples] for grain i.
+    # ---------------
+    def provenance(self,i):
+        return [self.sources[self.source_index[i]],int(self.source_offset[i])]
+
+# ---------------
+# load
+# Opens a corpus written by build.
+# ---------------
+def load(path):
+    return corpus(path)
+
+if __name__ == '__main__':
+    parser = ap.ArgumentParser(formatter_class=ap.ArgumentDefaultsHelpFormatter,
+        epilog="Any analysis option of iota.py can follow the sources, e.g. -g, -c, -r, -f, -z, -k, --clusterer, --dtype, --seed")
+    parser.add_argument("corpus",help="Directory to write the corpus to, replacing any corpus already there")
+    parser.add_argument("--sources",nargs="+",required=True,help="Wav files to build the corpus from")
+    [args,rest] = parser.parse_known_args()
+    for filename in args.sources:
+        if not os.path.isfile(filename):
+            interface.parser_error("%s is not a file" % filename)
+    params = interface.parse_args(["-i",args.sources[0],"-o",args.corpus]+rest)
+    try:
+        build(args.corpus,args.sources,params)
+    except ValueError as e:
+        interface.parser_error(str(e))
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+
+import stats as st
+
+# ---------------
+# analysis_settings
+# Every parameter that changes the analysis of a source. Analyses are reused until one of these changes.
+# The seed is one of them, as the feature bins and clustering are drawn from the random state it sets
+# (as for the cache, see cache.analysis_key).
+# ---------------
+def analysis_settings(params):
+    return (params.dtype,params.grain_size_ms,params.grain_spacing_ms,params.num_groups,params.num_features,params.dzc,
+        params.onsets,params.clusterer,params.cluster_iterations,params.cluster_batch,params.seed)
+
+# ---------------
+# engine
+# Runs iota in separate analyse, generate and render steps, so one process can render a source
+# many times. The source audio and its analysis are kept in memory and only redone when the source
+# file or one of the analysis settings changes. The heavy modules (scipy and friends) are only
+# imported once a step needs them.
+# Each render gets a fresh stats structure, which the hooks (see stats.stats) are passed on to.
+# With params.corpus set the grains come from a corpus built by corpus.py instead, whose grain
+# size, sample rate and groups then override the parameters.
+# ---------------
+class engine:
+    def __init__(self,params=None,hooks=None):
+        self.params = params
+        self.hooks = [] if hooks == None else list(hooks)
+        self.stats = st.stats(self.hooks)
+        self.source_file = None
+        self.source_audio = None
+        self.corpus = None
+        self.sample_rate = None
+        self.settings = None
+        self.bank = None
+        self.event_list = None
+        self.event_groups = None
+        self.features = None
+
+    # ---------------
+    # use
+    # Swaps in a new set of parameters, if given, and fills in the ones that depend on the sample rate.
+    # ---------------
+    def use(self,params=None):
+        if params != None:
+            self.params = params
+        if self.params == None:
+            raise ValueError("No parameters given to the engine")
+        if self.sample_rate != None:
+            self.params.sample_rate = self.sample_rate
+            self.params.grain_size = (self.sample_rate*self.params.grain_size_ms)/1000
+            self.params.grain_spacing = (self.sample_rate*self.params.grain_spacing_ms)/1000
+        if self.corpus != None and self.params.corpus == self.source_file:
+            meta = self.corpus.meta
+            if self.params.grain_size_ms != meta['grain_size_ms']:
+                print "Warning: grain size changed from %dms to the corpus' %dms." % (self.params.grain_size_ms,meta['grain_size_ms'])
+            self.params.grain_size_ms,self.params.grain_size = meta['grain_size_ms'],self.corpus.grain_size
+            self.params.grain_spacing_ms = meta['grain_spacing_ms']
+            self.params.grain_spacing = (self.sample_rate*self.params.grain_spacing_ms)/1000
+            self.params.num_groups = self.corpus.num_groups
+        return self.params
+
+    # ---------------
+    # load
+    # Opens the source audio, unless it is the file that's already open (at the same precision).
+    # The file is memory-mapped (see audio.wavsource), only the parts that are used are ever read.
+    # ---------------
+    def load(self,infile,dtype='float32'):
+        if infile == self.source_file and self.source_audio.dtype == dtype:
+            return
+        import audio as au
+        with self.stats.stage('read'):
+            self.source_audio = au.wavsource(infile,dtype)
+            self.sample_rate = self.source_audio.sample_rate
+        self.source_file = infile
+        self.corpus = None
+        self.settings = None
+
+    # ---------------
+    # load_corpus
+    # Opens a corpus, unless it's the one already open. Opening one only maps its files.
+    # ---------------
+    def load_corpus(self,path):
+        if path == self.source_file and self.corpus != None:
+            return
+        import corpus as cp
+        with self.stats.stage('read'):
+            self.corpus = cp.load(path)
+        self.source_file = path
+        self.source_audio = None
+        self.sample_rate = self.corpus.sample_rate
+        self.bank = self.corpus.bank()
+        [self.event_list,self.event_groups,self.features] = [self.corpus.source_offset,self.corpus.labels,self.corpus.features]
+        self.settings = None
+
+    # ---------------
+    # analyse
+    # Groups the events of the source into a grain bank, reusing the last analysis when nothing it depends on has changed.
+    # Returns [bank,event_list,event_groups,features].
+    # ---------------
+    def analyse(self,params=None):
+        params = self.use(params)
+        if params.corpus != None:
+            self.load_corpus(params.corpus)
+            self.use()
+            return [self.bank,self.event_list,self.event_groups,self.features]
+        self.load(params.infile,params.dtype)
+        params = self.use()
+        settings = analysis_settings(params)
+        if settings != self.settings:
+            import grouping as grp
+            [self.bank,self.event_list,self.event_groups,self.features] = grp.group_events(self.source_audio,self.sample_rate,params,self.stats)
+            self.settings = settings
+        return [self.bank,self.event_list,self.event_groups,self.features]
+
+    # ---------------
+    # generate
+    # Generates and mixes the grain streams for the current parameters, and returns the mixer.
+    # The caller should close the mixer once done with it.
+    # ---------------
+    def generate(self,params=None):
+        params = self.use(params)
+        self.analyse()
+        import generator as gen
+        self.stats.num_events = len(self.event_list)
+        self.stats.sample_rate = self.sample_rate
+        generators = {'loop':gen.group_loop,'block':gen.block_generator,'target':gen.target_generator,'cloud':gen.cloud_generator}
+        if not params.mode in generators:
+            raise ValueError("Unknown generator mode %s" % params.mode)
+        with self.stats.stage('generation'):
+            mix = generators[params.mode](self.sample_rate,params,self.bank,self.features,self.stats)
+        self.stats.output_length = mix.audio.shape[1]
+        return mix
+
+    # ---------------
+    # render
+    # Generates, post-processes and writes one output file. Returns the name of the file written.
+    # The stats of the render are left in self.stats.
+    # ---------------
+    def render(self,params=None,outfile=None):
+        params = self.use(params)
+        if outfile == None:
+            outfile = params.outfile
+        self.stats = st.stats(self.hooks)
+        mix = self.generate()
+        import audio as au
+        print "Post-processing.."
+        try:
+            au.write_audio_chunks(outfile,self.sample_rate,au.post_process_chunks(mix.audio,params,stats=self.stats),self.stats)
+        finally:
+            mix.close()
+        self.stats.finish()
+        if params.stats_file != None:
+            self.stats.write_json(params.stats_file)
+        return outfile
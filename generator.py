@@ -1,23 +1,31 @@
 #!/usr/bin/env python
 
 import numpy as np
+import multiprocessing as mp
+from multiprocessing.sharedctypes import RawArray
+import ctypes
 import grainstream as gs
 import audio as au
 import interface
+import stats as st
 
 # ---------------
 # effects_manager
 # Decides whether grains should have effects applied to them.
+# Decisions are made for any number of grains at once and returned as effect codes: bit b of a
+# grain's code is set if it should get effect b (the b-th effect in the fx list).
 # ---------------
 class effects_manager:
     # ---------------
     # __init__
-    # Apart from initialising structure contents, also creates a list of unique FX identifiers.
+    # Apart from initialising structure contents, also creates a list of unique FX identifiers
+    # and a threshold table for each effect: the feature it's decided on, the distribution of
+    # values a grain's feature has to beat, and what the effect is.
     # ---------------
-    def __init__(self,fx,features):
+    def __init__(self,fx,features,rng=np.random):
         self.filter_list = ['lowpass','highpass'] # just so it's not assigned a billion times
         self.fx = fx
-        self.fx_features = np.random.permutation(range(0,features.shape[0]))
+        self.fx_features = rng.permutation(range(0,features.shape[0]))
         self.fx_identifiers = []
         self.fx_distributions = []
         for x in self.fx:
@@ -27,58 +35,214 @@ class effects_manager:
                 feat_sorted = np.sort(features[self.fx_features[feat_num]])
                 dist_len = int(len(feat_sorted) - len(feat_sorted) * x[2])
                 self.fx_distributions.append(feat_sorted[dist_len:])
-                
-    # ---------------
-    # grain_fx
-    # Decides whether a grain should have any effects applied to it.
-    # ---------------
-    def grain_fx(self,grain):
-        effects = []
+        self.fx_rows = []
+        self.fx_thresholds = []
+        self.fx_effects = []
         for f in self.fx:
             ident_num = self.fx_identifiers.index(f[1])
-            if grain.features[self.fx_features[ident_num]] >= np.random.choice(self.fx_distributions[ident_num]):
-                if f[0] in self.filter_list:
-                    effects.append(['filter',f[0],f[3],f[4],f[5]])
-                elif f[0] == "convolve":
-                    effects.append(['convolve'])
-        return effects
+            self.fx_rows.append(self.fx_features[ident_num])
+            self.fx_thresholds.append(self.fx_distributions[ident_num])
+            if f[0] in self.filter_list:
+                self.fx_effects.append(['filter',f[0],f[3],f[4],f[5]])
+            else:
+                self.fx_effects.append(['convolve'])
+
+    # ---------------
+    # decide
+    # Decides the effects for a batch of grains, given their features (one column per grain),
+    # and returns an effect code for each grain.
+    # ---------------
+    def decide(self,features,rng=np.random):
+        codes = np.zeros(features.shape[1],dtype=np.int64)
+        for b in range(0,len(self.fx)):
+            thresholds = self.fx_thresholds[b]
+            if len(thresholds) > 0:
+                chosen = thresholds[rng.randint(0,len(thresholds),features.shape[1])]
+                codes |= (features[self.fx_rows[b]] >= chosen).astype(np.int64) << b
+        return codes
+
+# ---------------
+# streamjob
+# Everything needed to render any subset of the streams of one generator mode.
+# render_chunk is the function that renders a range of streams.
+# ---------------
+class streamjob:
+    def __init__(self,render_chunk,sample_rate,params,bank,features,num_grains):
+        self.render_chunk = render_chunk
+        self.sample_rate = sample_rate
+        self.params = params
+        self.bank = bank
+        self.num_grains = num_grains
+        self.length = (num_grains+1)*params.grain_size # one extra grain for the stream offsets
+        self.hooks = [] # stats hooks, for the streams rendered in this process
+        self.seed = params.seed
+        if self.seed == None:
+            self.seed = np.random.randint(0,2**31)
+        self.fx_man = None
+        if len(params.fx) > 0:
+            # drawn from the render seed, so a reused analysis doesn't change which features pick effects
+            self.fx_man = effects_manager(params.fx,features,np.random.RandomState(self.seed))
+
+    # ---------------
+    # new_stream
+    # Creates stream j around its block of gathered audio.
+    # ---------------
+    def new_stream(self,j,_audio,rng):
+        print "Generating grain stream %d/%d.." % (j+1,self.params.num_streams)
+        grain_size = self.params.grain_size
+        stream = gs.grainstream((grain_size/self.params.num_streams)*j,grain_size,self.num_grains,self.sample_rate,_audio,rng)
+        stream.pan_law = self.params.pan_law
+        return stream
+
+    # ---------------
+    # add_effects
+    # Decides on effects for the grains of a stream and applies them.
+    # Only grains where active is True are considered.
+    # ---------------
+    def add_effects(self,stream,grain_idx,active,rng,stats):
+        if self.fx_man == None:
+            return
+        grain_nums = np.where(active)[0]
+        codes = self.fx_man.decide(self.bank.features[:,grain_idx[grain_nums]],rng)
+        stream.apply_all_effects(grain_nums,codes,self.fx_man.fx_effects,stats)
+
+# ---------------
+# stream_rng
+# Every stream gets its own random number generator, seeded from the render seed and the
+# stream number, so a stream comes out the same no matter which process renders it.
+# ---------------
+def stream_rng(seed,j):
+    return np.random.RandomState([seed,j])
+
+# ---------------
+# render_streams
+# Renders and mixes every stream of a job, either in this process or spread across a pool of
+# workers, and returns the mixer holding the stereo mix. Streams are mixed into a partial mix per group of
+# mix_group streams as soon as they're rendered, so only a few streams ever exist at once, and
+# the partial mixes are added up in order. The arithmetic is the same for any number of workers.
+# Partial mixes go into a fixed set of buffers that are reused from group to group: one when
+# rendering here, or one per worker plus one in shared memory (or temp files), which the workers write
+# into and the parent adds up. A group is only handed out once the buffer it will use has been
+# added into the mix, so memory stays at a few output lengths whatever the number of streams.
+# The workers read grains from a copy of the source in shared memory (or from the same mapped
+# file, for a wavsource), which they inherit when the pool is created, so the grain bank is never pickled.
+# If rendering fails the mix is closed before the error is passed on, so no temp file is left behind.
+# ---------------
+mix_group = 4
+_job = None
+_partials = None
+def render_streams(job,stats):
+    global _job,_partials
+    num_streams,workers = job.params.num_streams,job.params.workers
+    groups = [(j,min(j+mix_group,num_streams)) for j in range(0,num_streams,mix_group)]
+    mix = au.mixer(job.length,job.params.temp_dir,job.params.dtype)
+    partials = []
+    pool = None
+    try:
+        if workers <= 1:
+            job.hooks = stats.hooks
+            partials.append(au.mixer(job.length,job.params.temp_dir,job.params.dtype))
+            for start,stop in groups:
+                stats.add(mix_streams(job,start,stop,partials[0]))
+                with stats.stage('mixdown'):
+                    mix.add_mix(partials[0])
+            return mix
+        source = job.bank.source
+        if not hasattr(source,'raw') and not isinstance(source,np.memmap): # a mapped file is already shared
+            shared = np.frombuffer(RawArray(ctypes.c_byte,source.nbytes),dtype=source.dtype)
+            shared[:] = source
+            job.bank.set_source(shared)
+        for i in range(0,min(workers+1,len(groups))):
+            partials.append(au.mixer(job.length,job.params.temp_dir,job.params.dtype,shared=True))
+        _job,_partials = job,partials
+        pool = mp.Pool(workers)
+        pending = [pool.apply_async(_mix_streams,(groups[g],g)) for g in range(0,len(partials))]
+        for g in range(0,len(groups)):
+            _stats = pending[g].get()
+            with stats.stage('mixdown'):
+                mix.add_mix(partials[g % len(partials)])
+            stats.add(_stats)
+            if g+len(partials) < len(groups):
+                pending.append(pool.apply_async(_mix_streams,(groups[g+len(partials)],g % len(partials))))
+        return mix
+    except:
+        mix.close() # the caller never gets it, so its temp file would be left behind
+        raise
+    finally:
+        if pool != None:
+            pool.terminate()
+        _job,_partials = None,None
+        for partial in partials:
+            partial.close()
+
+# ---------------
+# mix_streams
+# Renders streams [start,stop) and mixes them together into mix, which is cleared first, and
+# returns the stats of the streams. Streams are rendered a few at a time, as many as fit in
+# gather_size samples (but at least one).
+# ---------------
+gather_size = 1<<24
+def mix_streams(job,start,stop,mix):
+    _stats = st.stats(job.hooks)
+    with _stats.stage('mixdown'):
+        mix.clear()
+    step = max(1,gather_size/(job.num_grains*job.params.grain_size))
+    for j in range(start,stop,step):
+        with _stats.stage('render'):
+            streams = job.render_chunk(job,j,min(j+step,stop),_stats)
+        with _stats.stage('mixdown'):
+            for stream in streams:
+                mix.add(stream)
+    return _stats
+
+# ---------------
+# _mix_streams
+# Pool task: mix_streams for the job inherited from the parent process, into one of the partial mixes it shares.
+# ---------------
+def _mix_streams(group,partial):
+    return mix_streams(_job,group[0],group[1],_partials[partial])
 
 # ---------------
 # group_loop
-# Loops through every grain group a specified number of times and interpolates between them.
+# Loops through every grain group a specified number of times and interpolates between them,
+# and returns the mixed streams.
+# The group and grain for every slot are drawn for each stream in a couple of calls, and the
+# audio for a whole range of streams is gathered from the grain bank at once. Only grains with
+# effects are then visited one by one.
 # ---------------
-def group_loop(sample_rate,params,grain_groups,features,stats):
-    streams = []
+def group_loop(sample_rate,params,bank,features,stats):
     num_repeats,num_grains = params.modevars
-    fx,num_streams,num_groups,grain_size = params.fx,params.num_streams,params.num_groups,params.grain_size
-    
-    if len(fx) > 0:
-        fx_man = effects_manager(fx,features)
-
-    for j in range(0,num_streams):
-        print "Generating grain stream %d/%d.." % (j+1,num_streams)
-        streams.append(gs.grainstream((grain_size/num_streams)*j,grain_size,num_grains*num_groups*num_repeats,sample_rate))
-        for x in range(0,num_groups*num_repeats):
-            for i in range(0,num_grains):
-                if np.random.randint(0,num_grains)<=i:
-                    g = (x+1) % num_groups
-                else:
-                    g = x % num_groups
-                grain = grain_groups[g].random_grain()
-                if len(fx) > 0:
-                    effects = fx_man.grain_fx(grain)
-                else:
-                    effects = []
-                streams[j].extend(grain,effects,stats)
+    job = streamjob(loop_chunk,sample_rate,params,bank,features,num_grains*params.num_groups*num_repeats)
+    return render_streams(job,stats)
+
+def loop_chunk(job,start,stop,stats):
+    num_repeats,num_grains = job.params.modevars
+    num_groups = job.params.num_groups
+    # Each slot takes from the next group with a probability that rises across the section
+    section = np.repeat(np.arange(0,num_groups*num_repeats),num_grains)
+    position = np.tile(np.arange(0,num_grains),num_groups*num_repeats)
+    rngs = [stream_rng(job.seed,j) for j in range(start,stop)]
+    grain_idx = np.empty([stop-start,job.num_grains],dtype=int)
+    for k,rng in enumerate(rngs):
+        interpolate = rng.randint(0,num_grains,job.num_grains) <= position
+        grain_idx[k] = job.bank.random_indices((section+interpolate) % num_groups,rng)
+    streams_audio = job.bank.gather(grain_idx)
+
+    streams = []
+    for k,rng in enumerate(rngs):
+        streams.append(job.new_stream(start+k,streams_audio[k],rng))
+        streams[k].fill(job.num_grains,stats)
+        job.add_effects(streams[k],grain_idx[k],np.ones(job.num_grains,dtype=bool),rng,stats)
     return streams
 
 # ---------------
 # block_generator
-# Generates blocks of audio from grain groups depending on user input.
+# Generates blocks of audio from grain groups depending on user input, and returns the mixed streams.
+# Groups are picked for every grain of a stream in one go. Empty slots are marked as
+# silence in each stream instead of being filled with copies of an empty grain.
 # ---------------
-def block_generator(sample_rate,params,grain_groups,features,stats):
-    num_streams,grain_size,emptiness,block_list,fx = params.num_streams,params.grain_size,params.emptiness,params.modevars,params.fx
-    empty_grain = gs.grain(np.zeros(grain_size)+0.0000001,[]) # avoid divide by zero
+def block_generator(sample_rate,params,bank,features,stats):
+    emptiness,block_list = params.emptiness,params.modevars
     # parse user input and find unique identifiers to match to groups
     unique_identifiers = list(set([x for x,y,z,w in block_list]))
     num_groups = len(unique_identifiers)
@@ -90,29 +254,135 @@ def block_generator(sample_rate,params,grain_groups,features,stats):
         group_dist[group,_start:_end] += au.tukey(_end-_start,alpha)
     group_dist[num_groups,:] = emptiness
     
-    if len(fx) > 0:
-        fx_man = effects_manager(fx,features)
-    
+    job = streamjob(block_chunk,sample_rate,params,bank,features,num_grains)
+    job.group_dist = group_dist
+    return render_streams(job,stats)
+
+def block_chunk(job,start,stop,stats):
+    num_groups = job.group_dist.shape[0]-1
+    rngs = [stream_rng(job.seed,j) for j in range(start,stop)]
+    grain_idx = np.empty([stop-start,job.num_grains],dtype=int)
+    silent = np.empty([stop-start,job.num_grains],dtype=bool)
+    for k,rng in enumerate(rngs):
+        # apply a bit of randomness and select the group with the highest probability
+        r = rng.rand(num_groups+1,job.num_grains) * job.group_dist
+        groups = np.argmax(r,axis=0)
+        silent[k] = (groups == num_groups) | (np.amax(r,axis=0) == 0.) # last group is emptiness
+        groups[silent[k]] = -1
+        grain_idx[k] = job.bank.random_indices(groups,rng)
+    streams_audio = np.empty([stop-start,job.num_grains,job.params.grain_size],dtype=job.params.dtype)
+    streams_audio[~silent] = job.bank.gather(grain_idx[~silent])
+    streams_audio[silent] = 0.0000001 # avoid divide by zero
+
     streams = []
-    for j in range(0,num_streams):
-        print "Generating grain stream %d/%d.." % (j+1,num_streams)
-        streams.append(gs.grainstream((grain_size/num_streams)*j,grain_size,num_grains,sample_rate))
-        for i in range(0,num_grains):
-            # apply a bit of randomness and select the group with the highest probability
-            r = np.random.rand(num_groups+1) * group_dist[:,i]
-            _r = max(r)
-            if _r == 0.:
-                streams[j].extend(empty_grain,[],stats)
-            else:
-                g = np.where(r==_r)[0][0] # look up group by index
-                if g == num_groups: # last group is emptiness
-                    streams[j].extend(empty_grain,[],stats) # duplicate code, I know, but it's faster this way (avoids where calls)
-                else:
-                    grain = grain_groups[g].random_grain()
-                    if len(fx) > 0:
-                        effects = fx_man.grain_fx(grain)
-                    else:
-                        effects = []
-                    streams[j].extend(grain,effects,stats)
+    for k,rng in enumerate(rngs):
+        streams.append(job.new_stream(start+k,streams_audio[k],rng))
+        streams[k].fill(job.num_grains,stats,silent[k])
+        job.add_effects(streams[k],grain_idx[k],~silent[k],rng,stats)
+    return streams
+
+# ---------------
+# target_generator
+# Picks every grain by its features, following a target feature trajectory with one point per
+# grain slot, and returns the mixed streams. The target is either a wav file, analysed the same
+# way as the source, or a curve file (see read_curve). Each stream follows the target with a bit of
+# its own jitter and picks one of the nearest few grains at random, so the streams don't all
+# play the same grains. Neighbours come from a k-d tree over the bank's feature matrix.
+# ---------------
+def target_generator(sample_rate,params,bank,features,stats):
+    from scipy.spatial import cKDTree
+    targets = target_trajectory(params,bank)
+    job = streamjob(target_chunk,sample_rate,params,bank,features,targets.shape[1])
+    job.targets = np.transpose(targets)
+    job.tree = cKDTree(np.transpose(np.asarray(bank.features,dtype=float)))
+    return render_streams(job,stats)
+
+# Neighbours for every slot of every stream in the chunk come from one batched query.
+def target_chunk(job,start,stop,stats):
+    [target,num_neighbours,spread] = job.params.modevars
+    num_neighbours = min(num_neighbours,job.tree.n)
+    rngs = [stream_rng(job.seed,j) for j in range(start,stop)]
+    queries = np.empty([stop-start,job.num_grains,job.targets.shape[1]])
+    for k,rng in enumerate(rngs):
+        queries[k] = job.targets + rng.normal(0.,spread,job.targets.shape)
+    [distances,nearest] = job.tree.query(queries.reshape(-1,job.targets.shape[1]),num_neighbours)
+    nearest = nearest.reshape(stop-start,job.num_grains,num_neighbours)
+    grain_idx = np.empty([stop-start,job.num_grains],dtype=int)
+    for k,rng in enumerate(rngs):
+        grain_idx[k] = nearest[k,np.arange(0,job.num_grains),rng.randint(0,num_neighbours,job.num_grains)]
+    streams_audio = job.bank.gather(grain_idx)
+
+    streams = []
+    for k,rng in enumerate(rngs):
+        streams.append(job.new_stream(start+k,streams_audio[k],rng))
+        streams[k].fill(job.num_grains,stats)
+        job.add_effects(streams[k],grain_idx[k],np.ones(job.num_grains,dtype=bool),rng,stats)
     return streams
-            
\ No newline at end of file
+
+# ---------------
+# target_trajectory
+# Returns the target features for every grain slot, one column per slot.
+# A target wav has to be at the source's sample rate, as the features depend on it.
+# ---------------
+def target_trajectory(params,bank):
+    target = params.modevars[0]
+    if target.lower().endswith('.wav'):
+        import grouping as grp
+        source = au.wavsource(target,params.dtype)
+        if source.sample_rate != params.sample_rate:
+            raise ValueError("%s has a sample rate of %d, the source is %d" % (target,source.sample_rate,params.sample_rate))
+        if source.size < params.grain_spacing:
+            raise ValueError("%s is shorter than one analysis frame (%dms)" % (target,params.grain_spacing_ms))
+        print "Analysing target %s.." % target
+        return grp.frame_features(source,params.sample_rate,params.grain_spacing,params.grain_size,bank.feature_bins,bank.feature_scales)
+    return read_curve(target,bank.features.shape[0],params.grain_size/float(params.sample_rate))
+
+# ---------------
+# read_curve
+# Reads a target curve: a text file with one breakpoint per line, 'time f1 f2 .. fn', with the time
+# in seconds and a value (normally 0-1, like the normalised features) for each of the n features.
+# The curve is interpolated linearly at every grain slot, from 0 to the last breakpoint.
+# ---------------
+def read_curve(filename,num_features,slot_seconds):
+    curve = np.loadtxt(filename,ndmin=2)
+    if curve.shape[1] != num_features+1:
+        raise ValueError("%s has %d values per breakpoint, the source has %d features" % (filename,curve.shape[1]-1,num_features))
+    if np.any(np.diff(curve[:,0]) < 0):
+        raise ValueError("%s has breakpoints out of order" % filename)
+    slots = np.arange(0,int(curve[-1,0]/slot_seconds)+1)*slot_seconds
+    return np.array([np.interp(slots,curve[:,0],curve[:,f+1]) for f in range(0,num_features)])
+
+# ---------------
+# cloud_generator
+# Scatters grains over the output at random onsets instead of laying them out in streams, and
+# returns the mix. Density is in grains per second, so a cloud can hold thousands of overlapping
+# grains, with lengths anywhere in the given range. Like loop mode it moves through every group
+# over the length of the output, taking from the next group with a probability that rises across
+# each group's section. All the events go into one scheduler.eventtable and are rendered in one pass.
+# ---------------
+def cloud_generator(sample_rate,params,bank,features,stats):
+    import scheduler as sch
+    [density,duration,min_length,max_length] = params.modevars
+    seed = params.seed
+    if seed == None:
+        seed = np.random.randint(0,2**31)
+    rng = stream_rng(seed,0)
+    if len(params.fx) > 0:
+        print "Warning: effects aren't applied in cloud mode."
+    num_events = rng.poisson(density*duration)
+    print "Scheduling a cloud of %d grains.." % num_events
+    length = int(duration*sample_rate)
+    onsets = np.sort(rng.randint(0,length,num_events))
+    section = onsets*(float(params.num_groups)/length)
+    groups = (section.astype(int)+(rng.rand(num_events) < section % 1.)) % params.num_groups
+    grains = bank.random_indices(groups,rng)
+    lengths = rng.randint((min_length*sample_rate)/1000,(max_length*sample_rate)/1000+1,num_events)
+    lengths = np.clip(lengths,1,params.grain_size)
+    table = sch.eventtable(onsets,grains,np.ones(num_events),rng.normal(0.,0.4,num_events),lengths)
+    mix = au.mixer(length+params.grain_size,params.temp_dir,params.dtype)
+    try:
+        sch.render(table,bank,mix.audio,stats,params.pan_law)
+    except:
+        mix.close()
+        raise
+    return mix
@@ -1,8 +1,8 @@
 #!/usr/bin/env python
 
 import numpy as np
-import scipy.signal as sig
 import scipy.fftpack as fftp
+from numpy.lib.stride_tricks import as_strided
 import audio as au
 
 # ---------------
@@ -10,46 +10,92 @@ import audio as au
 # A class comprising one stream of grains.
 # ---------------
 class grainstream:
-    def __init__(self,offset,grain_size,num_grains,sample_rate):
-        self.audio = np.empty([num_grains,grain_size])
-        self.grains = []
+    def __init__(self,offset,grain_size,num_grains,sample_rate,_audio=None,rng=np.random):
+        if _audio is None:
+            _audio = np.empty([num_grains,grain_size],dtype=np.float32)
+        self.audio = _audio
+        self.pan = rng.normal(0.,0.4,num_grains) # pan value per grain
+        self.pan_law = 'linear' # see audio.pan_gains
+        self.silent = np.zeros(num_grains,dtype=bool)
         self.next_grain = 0
         self.need_update = False
         self.offset = offset
         self.grain_size = grain_size
         self.sample_rate = sample_rate
-        self.grain_window = au.tukey(grain_size,0.1)
+        self.grain_window = au.tukey(grain_size,0.1).astype(_audio.dtype)
 
     # ---------------
-    # extend
-    # Adds a grain onto the audio array and applies any effects to it.
-    # ---------------
-    def extend(self,grain,effects,stats):
-        global conv_count
-        _audio = grain.get_audio()
-        if effects:
-            for e in effects:
-                if e[0] == 'filter':
-                    _audio = au.filter_audio(_audio,self.sample_rate,e[1],e[2],e[3],e[4])
-                    stats.filterings += 1
-                if e[0] == 'convolve' and self.next_grain>0:
-                    stats.convolutions += 1
-                    _max = np.amax(np.abs(_audio))
-                    _audio = sig.fftconvolve(_audio,self.audio[self.next_grain-1],mode="same")
-                    _audio = au.normalise(_audio,_max)*self.grain_window
-                    nn = np.amax(np.abs(_audio))
-        self.audio[self.next_grain] = _audio
-        self.grains.append(grain)
-        self.next_grain += 1
-        stats.num_grains += 1
-    # ---------------
-    # pad
-    # Small but super important. Makes each grain stream start at a slightly different offset,
-    # in order to prevent strange resonances and allow a full textures.
-    # ---------------
-    def pad(self,_audio):
-        return np.concatenate([np.zeros(self.offset),_audio,np.zeros(self.grain_size-self.offset)])
-    
+    # fill
+    # Marks the next n grains as filled, once they've been written into the audio array
+    # (e.g. by a grainbank gather).
+    # silent optionally marks which of them are empty.
+    # ---------------
+    def fill(self,n,stats,silent=None):
+        if silent is not None:
+            self.silent[self.next_grain:self.next_grain+n] = silent
+        self.next_grain += n
+        stats.num_grains += n
+
+    # ---------------
+    # apply_all_effects
+    # Applies effects to the grains numbered grain_nums, in batches. codes holds an effect code
+    # for each grain: bit b is set if the grain gets fx_effects[b], and effects are applied in bit order.
+    # A convolution uses the finished grain before, so grains are put into levels: grains without
+    # a convolution are level 0, and a grain with one is a level higher than the grain before it.
+    # Each level is done after the one below it, so every grain it convolves with is finished.
+    # Within a level, all grains with the same effect at the same position in their lists of
+    # effects are processed at once.
+    # ---------------
+    def apply_all_effects(self,grain_nums,codes,fx_effects,stats):
+        grain_nums = np.asarray(grain_nums,dtype=int)
+        conv_bits = sum([1<<b for b in range(0,len(fx_effects)) if fx_effects[b][0] == 'convolve'])
+        codes = np.where(grain_nums == 0,codes & ~conv_bits,codes) # nothing to convolve the first grain with
+        dependent = (codes & conv_bits) != 0
+        chained = np.zeros(len(codes),dtype=bool)
+        chained[1:] = dependent[1:] & dependent[:-1] & (grain_nums[1:] == grain_nums[:-1]+1)
+        run_start = np.maximum.accumulate(np.where(chained,0,np.arange(0,len(codes))))
+        levels = np.where(dependent,np.arange(0,len(codes))-run_start+1,0)
+        for level in np.unique(levels[codes != 0]):
+            in_level = (levels == level) & (codes != 0)
+            level_codes,level_nums = codes[in_level],grain_nums[in_level]
+            ops = dict([(c,[b for b in range(0,len(fx_effects)) if (c >> b) & 1]) for c in np.unique(level_codes)])
+            for p in range(0,max([len(o) for o in ops.values()])):
+                batches = {}
+                for c,o in ops.items():
+                    if len(o) > p:
+                        batches.setdefault(o[p],[]).append(level_nums[level_codes == c])
+                for b,nums in batches.items():
+                    nums = np.concatenate(nums)
+                    e = fx_effects[b]
+                    if e[0] == 'filter':
+                        self.audio[nums] = au.filter_batch(self.audio[nums],self.sample_rate,*e[1:])
+                        stats.filterings += len(nums)
+                    elif e[0] == 'convolve':
+                        self.convolve_batch(nums)
+                        stats.convolutions += len(nums)
+
+    # ---------------
+    # convolve_batch
+    # Convolves each of the grains numbered nums with the grain before it, normalises the results
+    # to the level of the original grains and windows them. Each operand and each kernel is
+    # transformed once, in a multi-row fft, and normalising and windowing are done for the whole batch.
+    # ---------------
+    def convolve_batch(self,nums):
+        n = fftp.next_fast_len(2*self.grain_size-1)
+        start = (self.grain_size-1)/2 # where fftconvolve's "same" output starts
+        batch_size = max(1,(1<<22)/n)
+        for j in range(0,len(nums),batch_size):
+            _nums = nums[j:j+batch_size]
+            _audio = self.audio[_nums]
+            spectra = np.fft.rfft(_audio,n,axis=1)
+            spectra *= np.fft.rfft(self.audio[_nums-1],n,axis=1)
+            convolved = np.fft.irfft(spectra,n,axis=1)[:,start:start+self.grain_size]
+            peaks = np.amax(np.abs(convolved),axis=1)
+            peaks[peaks == 0.] = 1.
+            convolved *= (np.amax(np.abs(_audio),axis=1)/peaks)[:,np.newaxis]
+            convolved *= self.grain_window
+            self.audio[_nums] = convolved
+
     # ---------------
     # smooth_audio
     # Currently unused but may bring it back as an effect at some point.
@@ -60,7 +106,7 @@ class grainstream:
         for i in range(0,len(self.audio)):
             sg = np.zeros(self.audio[0].size)
             for j in range(-smooth_distance-1,smooth_distance+1):
-                if i+j >= 0 and i+j < len(self.grains) and j != 0:
+                if i+j >= 0 and i+j < self.next_grain and j != 0:
                     sg += self.audio[i+j]*(abs(j)/float(smooth_distance))
             smoothing_grains.extend(sg)
         smoothing_grains = np.array(smoothing_grains)
@@ -69,17 +115,33 @@ class grainstream:
         
     # ---------------
     # get_audio
-    # Applies random panning to the grain stream, pads it and returns it.
+    # Applies the random panning to the grain stream, pads it and returns it as [left,right].
+    # Both channels are views of the one stereo buffer the stream is mixed into.
     # ---------------   
     def get_audio(self):
-        _audio = self.audio.reshape(self.audio.size)
-        num_grains = self.audio.shape[0]
-        pan_g = np.random.normal(0.,0.4,num_grains) # pan value per grain
-        pan_a = np.repeat(pan_g,self.grain_size) # expands pan_g out to the audio domain
-        pan_l = np.clip(-pan_a+1,0.,1.)
-        pan_r = np.clip(pan_a+1,0.,1.)
-        return [self.pad(_audio*pan_l),self.pad(_audio*pan_r)]
+        out = np.zeros([2,self.get_length()],dtype=self.audio.dtype)
+        self.mix_into(out)
+        return [out[0],out[1]]
     
+    # ---------------
+    # mix_into
+    # Applies the random panning to the grain stream and adds it into a stereo buffer at the
+    # stream's offset. Gains are applied per grain by broadcasting over the grain matrix, without
+    # expanding them out, and silent grains get no gain. The panned grains are written into scratch
+    # (a buffer the shape of the stream's audio, which can be reused from stream to stream) so
+    # nothing the size of the stream is allocated.
+    # ---------------
+    def mix_into(self,out,scratch=None):
+        if scratch is None:
+            scratch = np.empty_like(self.audio)
+        gains = au.pan_gains(self.pan,self.pan_law)
+        for channel in range(0,2):
+            gain = gains[channel].astype(self.audio.dtype)
+            gain[self.silent] = 0.
+            dest = out[channel,self.offset:self.offset+self.audio.size].reshape(self.audio.shape)
+            np.multiply(self.audio,gain[:,np.newaxis],out=scratch)
+            dest += scratch
+
     # ---------------
     # get_length
     # Returns the length of the grain stream (with one extra grain length for padding).
@@ -88,33 +150,68 @@ class grainstream:
         return self.audio.size + self.grain_size
 
 # ---------------
-# grain
-# A class that stores the audio and features of one event.
+# grainbank
+# Stores every grain as an offset into the source audio, along with its group and features,
+# instead of keeping a windowed copy of each one. Grains are cut out and windowed when they're
+# asked for, any number at a time with a single gather.
 # ---------------
-class grain:
-    def __init__(self,_audio,features):
-        self.audio = _audio
+class grainbank:
+    def __init__(self,source,offsets,groups,features,grain_size,num_groups):
+        self.offsets = np.asarray(offsets,dtype=int)
+        self.groups = np.asarray(groups,dtype=int)
         self.features = features
+        self.grain_size = grain_size
+        self.feature_bins = None # how the features were made (see grouping.frame_features), set by the analysis
+        self.feature_scales = None
+        self.window = au.tukey(grain_size,0.1).astype(source.dtype)
+        self.graingroups = [graingroup(self,np.where(self.groups==g)[0]) for g in range(0,num_groups)]
+        self.set_source(source)
 
-    def get_audio(self):
-        return self.audio
+    # ---------------
+    # set_source
+    # Points the bank at a (possibly shared) buffer holding the same source audio, or at an
+    # audio.wavsource, in which case grains are converted from the mapped file as they're gathered.
+    # ---------------
+    def set_source(self,source):
+        self.source = source
+        raw = getattr(source,'raw',source)
+        # zero-copy view of the source with one row per sample offset, so grains are just rows
+        step = raw.strides[0]
+        self.frames = as_strided(raw,shape=(source.size-self.grain_size+1,self.grain_size),strides=(step,step))
+
+    # ---------------
+    # gather
+    # Returns the windowed audio of every grain in idx, which can be an array of any shape.
+    # The result has the shape of idx with an extra axis of grain_size samples.
+    # ---------------
+    def gather(self,idx,out=None):
+        return np.multiply(au.materialise(self.frames[self.offsets[idx]],self.window.dtype),self.window,out=out)
+
+    # ---------------
+    # random_indices
+    # Takes an array of group numbers of any shape and returns an array of the same shape
+    # with a random grain number from the respective group in each position.
+    # Negative group numbers (i.e. silence) are left as -1.
+    # ---------------
+    def random_indices(self,groups,rng=np.random):
+        idx = np.empty(groups.shape,dtype=int)
+        idx.fill(-1)
+        for g in range(0,len(self.graingroups)):
+            mask = groups == g
+            idx[mask] = self.graingroups[g].random_indices(np.count_nonzero(mask),rng)
+        return idx
 # ---------------
 # graingroup
-# A class used to group grains classes.
+# A group of grains in a grainbank, stored as an array of grain numbers.
 # ---------------
 class graingroup:
-    def __init__(self):
-        self.grains = []
-    
-    # ---------------
-    # add_grain
-    # Appends a grain to the grain group list.
-    # ---------------
-    def add_grain(self,_grain):
-        self.grains.append(_grain)
+    def __init__(self,bank,indices):
+        self.bank = bank
+        self.indices = indices
+
     # ---------------
-    # random_grain
-    # Returns a random grain from the grain list
+    # random_indices
+    # Returns n random grain numbers from the group.
     # ---------------
-    def random_grain(self):
-        return self.grains[np.random.randint(0,len(self.grains))]
\ No newline at end of file
+    def random_indices(self,n,rng=np.random):
+        return self.indices[rng.randint(0,len(self.indices),n)]
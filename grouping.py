@@ -1,13 +1,17 @@
 #!/usr/bin/env python
 
 import numpy as np
-from scipy.io import wavfile as wav
 import scipy.signal as sig
 import scipy.fftpack as fftp
-from scipy import log10, where
-from scipy.cluster.vq import kmeans2 as kmeans
+from numpy.lib.stride_tricks import as_strided
+from scipy import log10
+from scipy.ndimage import maximum_filter1d
+
+import os
 
 import grainstream as gs
+import stats as st
+import cache
 import audio as au
 import interface
 # ---------------
@@ -24,65 +28,290 @@ def select_events(audio,ev_spacing,grain_size):
         i += ev_spacing
     return _events
 # ---------------
+# analysisplane
+# Frames a source once at a fixed hop and holds everything the feature extractors need:
+# the framed signal (a zero-copy strided view), the low bins of its magnitude spectrum in dB and
+# some per-frame time-domain stats. Spectra are calculated in batches with one multi-row fft per
+# batch, and only the bins the spectral features can read (see feature_bin_limit) are kept, so
+# the plane is a fraction of the size of the full spectrum. With flux the spectral flux is worked
+# out from each batch's full spectrum before it's thrown away.
+# The source can be an array or an audio.wavsource, in which case the frames are a view of the
+# mapped file and only one batch of them is converted at a time.
+# ---------------
+class analysisplane:
+    def __init__(self,audio,sample_rate,frame_size,hop,batch_samples=1<<20,flux=False):
+        self.audio = audio
+        self.sample_rate = sample_rate
+        self.frame_size = frame_size
+        self.hop = hop
+        self.num_frames = (audio.size-frame_size)/hop+1
+        raw = getattr(audio,'raw',audio)
+        step = raw.strides[0]
+        self.frames = as_strided(raw,shape=(self.num_frames,frame_size),strides=(step*hop,step))
+        dtype = np.promote_types(audio.dtype,np.float32) # analyse at the precision of the source, but at least float32
+        self.window = sig.hann(frame_size).astype(dtype)
+        self.num_bins = min(frame_size,feature_bin_limit(frame_size))
+        self.mags = np.empty((self.num_frames,self.num_bins),dtype=dtype)
+        self.rms = np.empty(self.num_frames,dtype=dtype)
+        self.flux = np.zeros(self.num_frames) if flux else None
+        previous = None
+        batch_size = max(1,batch_samples/frame_size)
+        for i in range(0,self.num_frames,batch_size):
+            _frames = au.materialise(self.frames[i:i+batch_size],dtype)
+            self.rms[i:i+batch_size] = np.sqrt(np.mean(np.square(_frames),axis=1))
+            mags = 20*log10(abs(fftp.rfft(_frames*self.window,frame_size,axis=1))) # dB
+            self.mags[i:i+batch_size] = mags[:,:self.num_bins]
+            if flux:
+                # sum of the positive changes in every bin since the frame before, which may be in the last batch.
+                # Silent bins are -inf dB, so they're floored first or their changes would be NaN
+                mags = np.maximum(mags,20*log10(np.finfo(dtype).tiny))
+                if previous is not None:
+                    mags = np.concatenate((previous,mags))
+                self.flux[max(i,1):i+batch_size] = np.sum(np.clip(np.diff(mags,axis=0),0.,None),axis=1)/frame_size
+                previous = mags[-1:]
+        # Time-domain stats: sign changes are counted with a running total across batches of the
+        # signal, and the total is looked up at the first and last sample of each frame
+        starts = np.arange(self.num_frames)*hop
+        ends = starts+frame_size-1
+        at_start = np.zeros(self.num_frames,dtype=int)
+        at_end = np.zeros(self.num_frames,dtype=int)
+        total = 0
+        for i in range(0,audio.size,batch_samples):
+            _aud = au.materialise(raw[max(i-1,0):i+batch_samples],dtype)
+            crossings = np.cumsum(_aud[:-1] * _aud[1:] < 0)
+            if i == 0:
+                crossings = np.concatenate([[0],crossings]) # the first sample has no crossing before it
+            crossings += total
+            stop = min(i+batch_samples,audio.size)
+            for positions,out in [(starts,at_start),(ends,at_end)]:
+                lo,hi = np.searchsorted(positions,[i,stop])
+                out[lo:hi] = crossings[positions[lo:hi]-i]
+            total = crossings[-1]
+        self.zero_crossings = at_end - at_start
+
+    # ---------------
+    # frame_index
+    # Converts a list of event positions (in samples) to frame numbers.
+    # ---------------
+    def frame_index(self,_events):
+        return np.asarray(_events,dtype=int)/self.hop
+
+    # ---------------
+    # spectral_flux
+    # Sum of the positive changes in every bin between consecutive frames.
+    # Only there if the plane was made with flux.
+    # ---------------
+    def spectral_flux(self):
+        if self.flux is None:
+            raise ValueError("Spectral flux wasn't calculated for this analysis plane")
+        return self.flux
+# ---------------
+# onset_events
+# An alternative to select_events. Picks events at peaks in the spectral flux of an analysis plane,
+# which should line up with transients in the source. Peaks have to be the highest point within
+# spacing samples either side and exceed a moving average of the flux by delta standard deviations.
+# ---------------
+def onset_events(plane,spacing,grain_size,delta=0.5):
+    print "Detecting onsets.."
+    flux = plane.spectral_flux()
+    span = max(1,spacing/plane.hop)
+    local_mean = np.convolve(flux,np.ones(4*span+1)/(4*span+1),"same")
+    peaks = (flux == maximum_filter1d(flux,2*span+1)) & (flux > local_mean + delta*np.std(flux))
+    _events = np.where(peaks)[0]*plane.hop
+    _events = _events[_events <= plane.audio.size-grain_size].tolist()
+    if len(_events) == 0:
+        print "Warning: no onsets detected, taking events at fixed intervals instead."
+        return select_events(plane.audio,spacing,grain_size)
+    return _events
+# ---------------
+# band_means
+# Calculates the mean of every [lo,hi) band of each row of mags using a cumulative sum lookup,
+# rather than slicing and averaging each band separately.
+# ---------------
+def band_means(mags,lo,hi):
+    _cumsum = np.zeros((mags.shape[0],np.amax(hi)+1))
+    np.cumsum(mags[:,:np.amax(hi)],axis=1,out=_cumsum[:,1:])
+    return (_cumsum[:,hi] - _cumsum[:,lo])/(hi-lo)
+# ---------------
 # spectral_features
-# Selects a random set of spectral features and calculates them for every event passed to it.
+# Selects a random set of spectral features and calculates them for every frame passed to it.
+# The feature bins can be given instead, so features from different sources are comparable.
+# ---------------
+def spectral_features(plane,frame_idx,n_features=20,featurewidth=16,feature_bins=None):
+    if feature_bins is None:
+        feature_bins = random_feature_bins(plane.frame_size,n_features,featurewidth)
+    lo,hi = feature_bins-featurewidth/2,feature_bins+featurewidth/2
+    if np.amax(hi) > plane.num_bins:
+        raise ValueError("Feature bins go up to bin %d, the analysis only keeps %d" % (np.amax(hi),plane.num_bins))
+    return np.transpose(band_means(abs(plane.mags[frame_idx]),lo,hi))
+# ---------------
+# random_feature_bins
+# Picks the centre bins of n_features random spectral bands.
 # ---------------
-def spectral_features(audio,_events,ev_spacing,n_features=20,featurewidth=16):
+def random_feature_bins(frame_size,n_features,featurewidth=16):
     print "Selecting %d random spectral features.." % n_features
-    feature_bins = np.random.randint(featurewidth/2,(ev_spacing/8),n_features)
-    _features = np.zeros((n_features,len(_events)))
-    ev_window = sig.hann(ev_spacing)
-    for i in range(0,len(_events)):
-        _ev = audio[_events[i]:_events[i]+ev_spacing]
-        # Calculate spectrogram for the event
-        _fftevent = _ev*ev_window
-        mags = abs(fftp.rfft(_fftevent,ev_spacing))
-        mags = 20*log10(mags) # dB
-        # Calculate each feature for this event
-        for j in range(0,n_features):
-            _features[j][i] = abs(np.mean(abs(mags[(feature_bins[j]-featurewidth/2):(feature_bins[j]+featurewidth/2)])))
-    return _features
+    return np.random.randint(featurewidth/2,(frame_size/8),n_features)
+# ---------------
+# feature_bin_limit
+# The number of spectral bins the features of a frame can read from, i.e. the top of the highest
+# band random_feature_bins can pick. Analysis planes keep no more than this.
+# ---------------
+def feature_bin_limit(frame_size,featurewidth=16):
+    return frame_size/8+featurewidth/2
 # ---------------
 # zero_crossings
-# Calculates the zero-crossing count for every event and uses it to get an approximation
+# Looks up the zero-crossing count for every frame and uses it to get an approximation
 # of the fundamental frequency.
 # ---------------
-def zero_crossings(audio,_events,ev_spacing):
-    _features = np.zeros((1,len(_events)))
-    for i in range(0,len(_events)):
-        _ev = audio[_events[i]:_events[i]+ev_spacing]
-        zerocrossings = len(where(_ev[:-1] * _ev[1:] < 0)[0])
-        f = zerocrossings*44100/ev_spacing
-        _features[0][i] = f
-    return _features
+def zero_crossings(plane,frame_idx):
+    zerocrossings = plane.zero_crossings[frame_idx]
+    return np.reshape(zerocrossings*plane.sample_rate/plane.frame_size,(1,len(frame_idx)))
 # ---------------
 # cluster
-# Runs k-means clustering on a set of features.
+# Runs k-means clustering on a set of features (one column per event) and returns the centroids
+# and the group of each event. Uses scipy's kmeans2, or mini-batch k-means for big event sets.
 # ---------------
-def cluster(_features,n_groups=5,iterations=30):
+def cluster(_features,n_groups=5,iterations=30,backend='kmeans2',batch_size=1024,tol=1e-4,seed=None):
     print "Clustering.."
-    return kmeans(np.transpose(_features),n_groups,minit='points',iter=30)
+    if backend == 'minibatch':
+        rng = np.random.RandomState(seed) if seed != None else np.random
+        chunks = lambda: (_features[:,i:i+batch_size*16] for i in range(0,_features.shape[1],batch_size*16))
+        return minibatch_kmeans(chunks,n_groups,iterations,batch_size,tol,rng)
+    from scipy.cluster.vq import kmeans2 as kmeans
+    return kmeans(np.transpose(_features),n_groups,minit='points',iter=iterations)
+# ---------------
+# nearest_centroids
+# Returns the index of the nearest centroid to every column of a feature matrix.
+# ---------------
+def nearest_centroids(_features,centroids):
+    distances = np.sum(centroids**2,axis=1)[:,np.newaxis] - 2*np.dot(centroids,_features)
+    return np.argmin(distances,axis=0)
+# ---------------
+# minibatch_kmeans
+# Mini-batch k-means. Features are read through chunks, a function that returns a fresh iterator
+# over feature matrices (one column per event) each time it's called, so they never all have to be
+# in memory at once. Each pass over the chunks moves the centroids towards the mean of every
+# mini-batch, with a step size that shrinks as a centroid is assigned more events. Stops early
+# once no centroid moves more than tol (relative to the spread of the features) in a pass.
+# The centroids start from a k-means++ pick from the first chunk, using rng.
+# ---------------
+def minibatch_kmeans(chunks,n_groups,iterations=30,batch_size=1024,tol=1e-4,rng=np.random):
+    first = np.asarray(next(iter(chunks())),dtype=float)
+    centroids = kmeans_plusplus(first,n_groups,rng)
+    scale = np.mean(np.var(first,axis=1))
+    counts = np.zeros(n_groups)
+    for it in range(0,iterations):
+        previous = centroids.copy()
+        for chunk in chunks():
+            chunk = np.asarray(chunk,dtype=float)
+            order = rng.permutation(chunk.shape[1])
+            for i in range(0,len(order),batch_size):
+                batch = chunk[:,order[i:i+batch_size]]
+                labels = nearest_centroids(batch,centroids)
+                batch_counts = np.bincount(labels,minlength=n_groups).astype(float)
+                sums = np.array([np.bincount(labels,batch[f],n_groups) for f in range(0,batch.shape[0])]).T
+                counts += batch_counts
+                moved = batch_counts > 0
+                centroids[moved] += (sums[moved] - batch_counts[moved,np.newaxis]*centroids[moved])/counts[moved,np.newaxis]
+        if np.amax(np.sum((centroids-previous)**2,axis=1)) <= tol*scale:
+            break
+    labels = np.concatenate([nearest_centroids(np.asarray(chunk,dtype=float),centroids) for chunk in chunks()])
+    return [centroids,labels]
+# ---------------
+# kmeans_plusplus
+# Picks initial centroids from the columns of a feature matrix: the first at random, then each
+# next one with a probability proportional to its squared distance from the nearest one so far.
+# ---------------
+def kmeans_plusplus(_features,n_groups,rng=np.random):
+    n = _features.shape[1]
+    centroids = np.empty((n_groups,_features.shape[0]))
+    centroids[0] = _features[:,rng.randint(0,n)]
+    distances = np.sum((_features-centroids[0][:,np.newaxis])**2,axis=0)
+    for c in range(1,n_groups):
+        total = np.sum(distances)
+        pick = rng.randint(0,n) if total <= 0. else np.searchsorted(np.cumsum(distances),rng.rand()*total)
+        centroids[c] = _features[:,min(pick,n-1)]
+        distances = np.minimum(distances,np.sum((_features-centroids[c][:,np.newaxis])**2,axis=0))
+    return centroids
+# ---------------
+# event_features
+# Selects events from some source audio and extracts their features, before normalisation.
+# Returns [event_list,spectral,frequencies,feature_bins], where frequencies is None if zero crossings are disabled.
+# If zero crossings are disabled, use x spectral features, otherwise use x-1 (zc makes the first feature).
+# ---------------
+def event_features(audio,sample_rate,params,feature_bins=None):
+    grain_size,spacing,no_zc = params.grain_size,params.grain_spacing,params.dzc
+    # Every feature is read from one analysis plane. Onset detection needs a finer hop than the event grid.
+    if params.onsets:
+        plane = analysisplane(audio,sample_rate,spacing,max(1,spacing/4),flux=True)
+        event_list = onset_events(plane,spacing,grain_size)
+    else:
+        plane = analysisplane(audio,sample_rate,spacing,spacing)
+        event_list = select_events(audio,spacing,grain_size)
+    frame_idx = plane.frame_index(event_list)
+    if feature_bins is None:
+        feature_bins = random_feature_bins(plane.frame_size,params.num_features-(1-no_zc))
+    spectral = spectral_features(plane,frame_idx,len(feature_bins),16,feature_bins)
+    frequencies = None if no_zc else zero_crossings(plane,frame_idx)
+    return [event_list,spectral,frequencies,feature_bins]
+# ---------------
+# feature_scales
+# What each row of a feature matrix was divided by when it was normalised: the zero-crossing
+# row (if there is one) and the spectral rows are normalised separately.
+# ---------------
+def feature_scales(spectral,frequencies):
+    scales = np.repeat(np.amax(np.abs(spectral)),spectral.shape[0])
+    if frequencies is not None:
+        scales = np.concatenate(([np.amax(np.abs(frequencies))],scales))
+    return scales.astype(float)
+# ---------------
+# frame_features
+# Features of every frame of some audio, framed like the analysis of a source (frame_size is the
+# source's grain spacing) but at any hop, and scaled with the source's feature bins and scales,
+# so they can be compared with the source's features. Returns one column per frame.
+# ---------------
+def frame_features(audio,sample_rate,frame_size,hop,feature_bins,scales):
+    plane = analysisplane(audio,sample_rate,frame_size,hop)
+    frame_idx = np.arange(0,plane.num_frames)
+    features = spectral_features(plane,frame_idx,len(feature_bins),16,np.asarray(feature_bins))
+    if len(scales) > len(feature_bins):
+        features = np.concatenate((zero_crossings(plane,frame_idx),features))
+    return features/np.asarray(scales)[:,np.newaxis]
+# ---------------
+# analyse_events
+# Selects events from some source audio, extracts features from them and clusters them.
+# ---------------
+def analyse_events(audio,sample_rate,params,stats=None):
+    [event_list,spectral,frequencies,feature_bins] = event_features(audio,sample_rate,params)
+    scales = feature_scales(spectral,frequencies)
+    features = au.normalise(spectral,1.0,in_place=True)
+    if frequencies is not None:
+        features = np.concatenate((au.normalise(frequencies,1.0),features))
+    num_groups = params.num_groups
+    with st.stage(stats,'clustering'):
+        [centroids,event_groups] = cluster(features,num_groups,params.cluster_iterations,params.clusterer,params.cluster_batch,seed=params.seed)
+    return [event_list,features,centroids,event_groups,feature_bins,scales]
 # ---------------
 # group_events
-# Selects events from some source audio, extracts features from them and groups them by clustering.
-# ---------------
-def group_events(audio,params):
-    grain_size,spacing,no_zc,num_groups,num_features = params.grain_size,params.grain_spacing,params.dzc,params.num_groups,params.num_features
-    event_list = select_events(audio,spacing,grain_size)
-    # If zero crossings are disabled, use x spectral features, otherwise use x-1 and make zc the first feature.
-    features = au.normalise(spectral_features(audio,event_list,spacing,num_features-(1-no_zc),16),1.0)
-    if not no_zc:
-        frequencies = au.normalise(zero_crossings(audio,event_list,spacing),1.0)
-        features = np.concatenate((frequencies,features))
-    [centroids,event_groups] = cluster(features,num_groups)
-    grain_window = au.tukey(grain_size,0.1)
-    events = []
-    gg = []
-    for i in range(0,num_groups):
-        events.append([])
-        gg.append(gs.graingroup())
-    for i in range(0,len(event_list)):
-        events[event_groups[i]] = np.append(events[event_groups[i]],int(event_list[i]))
-        gr = gs.grain(audio[int(event_list[i]):int(event_list[i])+grain_size]*grain_window,features[:,i])
-        gg[event_groups[i]].add_grain(gr)
-    return [gg,event_list,event_groups,features]
\ No newline at end of file
+# Analyses some source audio (or loads the analysis from the cache) and groups its events
+# into a grain bank.
+# ---------------
+def group_events(audio,sample_rate,params,stats=None):
+    grain_size,num_groups = params.grain_size,params.num_groups
+    analysis = None
+    if params.cache_dir != None:
+        if not os.path.isdir(params.cache_dir):
+            os.makedirs(params.cache_dir)
+        key = cache.analysis_key(audio,sample_rate,params)
+        analysis = cache.load(params.cache_dir,key)
+        if analysis != None:
+            print "Loaded analysis from cache (%s).." % key[:12]
+    if analysis == None:
+        with st.stage(stats,'analysis'):
+            analysis = analyse_events(audio,sample_rate,params,stats)
+        if params.cache_dir != None:
+            cache.store(params.cache_dir,key,*analysis,max_bytes=params.cache_size)
+    [event_list,features,centroids,event_groups,feature_bins,scales] = analysis
+    bank = gs.grainbank(audio,event_list,event_groups,features,grain_size,num_groups)
+    bank.feature_bins,bank.feature_scales = feature_bins,scales
+    return [bank,event_list,event_groups,features]
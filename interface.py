@@ -27,7 +27,7 @@ def to_float(x,e):
 # Just a structure to make passing parameters around a bit less fragile.
 # ---------------
 class parameters:
-    def __init__(self,infile,outfile,grain_size,grain_spacing,num_streams,num_groups,num_features,dzc,mode,modevars,fx,comp_thresh,comp_ratio,norm_level,fade_size,emptiness,debug):
+    def __init__(self,infile,outfile,grain_size,grain_spacing,num_streams,num_groups,num_features,dzc,mode,modevars,fx,comp_thresh,comp_ratio,norm_level,fade_size,emptiness,debug,onsets=False,cache_dir=None,cache_size=1<<30,workers=1,seed=None,temp_dir=None,comp_mode='window',comp_attack=5.,comp_release=100.,clusterer='kmeans2',cluster_iterations=30,cluster_batch=1024,stats_file=None,profile=None,profile_out='iota-profile',profile_interval=5.,dtype='float32',corpus=None,pan_law='linear'):
         self.infile = infile
         self.outfile = outfile
         self.grain_size_ms = grain_size
@@ -47,34 +47,81 @@ class parameters:
         self.fade_size = fade_size
         self.emptiness = emptiness
         self.debug = debug
+        self.onsets = onsets
+        self.cache_dir = cache_dir
+        self.cache_size = cache_size
+        self.workers = workers
+        self.seed = seed
+        self.temp_dir = temp_dir
+        self.comp_mode = comp_mode
+        self.comp_attack = comp_attack
+        self.comp_release = comp_release
+        self.clusterer = clusterer
+        self.cluster_iterations = cluster_iterations
+        self.cluster_batch = cluster_batch
+        self.stats_file = stats_file
+        self.profile = profile
+        self.profile_out = profile_out
+        self.profile_interval = profile_interval
+        self.dtype = dtype
+        self.corpus = corpus
+        self.pan_law = pan_law
+        self.sample_rate = 44100 # likewise
         
 # ---------------
 # parse_args
-# Parses all command line arguments and does a few basic sanitisations.
+# Parses all command line arguments (or the list argv, if given) and does a few basic sanitisations.
 # ---------------
-def parse_args():
+def parse_args(argv=None):
     parser = ap.ArgumentParser(formatter_class=ap.ArgumentDefaultsHelpFormatter)
     parser.add_argument("-i","--infile",help="Input audio file")
     parser.add_argument("-o","--outfile",help="Audio file to output to")
+    parser.add_argument("--corpus",help="Render from a grain corpus built with corpus.py instead of analysing an input file")
     parser.add_argument("-g","--grainsize",help="Length of each grain, in ms",type=int,default=20)
     parser.add_argument("-c","--grainspacing",help="Spacing between each grain in analysis, in ms",type=int,default=200)
     parser.add_argument("-s","--numstreams",help="Number of grain streams",type=int,default=100)
     parser.add_argument("-r","--numgroups",help="Number of groups to use for clustering",type=int,default=5)
     parser.add_argument("-f","--numfeatures",help="Number of features to use for clustering",type=int,default=8)
     parser.add_argument("-z","--disablezerocrossings",help="Don't use zero-crossings as a clustering feature",action="store_true")
-    parser.add_argument("-m","--mode",choices=["block","loop"],default="loop",help="Generator mode, read documentation for more information")
+    parser.add_argument("-k","--onsets",help="Take events from onsets detected in the source instead of at fixed intervals, grain spacing becomes the minimum gap between onsets",action="store_true")
+    parser.add_argument("--cachedir",help="Directory to cache analysis results in, so later runs on the same source with the same analysis settings can skip analysis")
+    parser.add_argument("--cachesize",type=float,default=1024.,help="Maximum size of the analysis cache in MB, least recently used entries are removed beyond it")
+    parser.add_argument("-w","--workers",type=int,default=1,help="Number of processes to render grain streams with")
+    parser.add_argument("--seed",type=int,help="Random seed, renders with the same seed and settings are identical whatever the number of workers")
+    parser.add_argument("--tempdir",help="Mix on disk in this directory instead of in memory, for renders too long to hold in memory")
+    parser.add_argument("--clusterer",choices=["kmeans2","minibatch"],default="kmeans2",help="Clustering backend, minibatch is much faster on very large numbers of events")
+    parser.add_argument("--clusteriters",type=int,default=30,help="Maximum number of clustering iterations (passes over the events for minibatch)")
+    parser.add_argument("--clusterbatch",type=int,default=1024,help="Mini-batch size for the minibatch clusterer")
+    parser.add_argument("-m","--mode",choices=["block","loop","target","cloud"],default="loop",help="Generator mode, read documentation for more information")
     parser.add_argument("-l","--numloops",type=int,default=3,help="Number of loops to use in loop mode")
     parser.add_argument("-p","--grouplength",type=float,default=2.0,help="Number of seconds each group should last in loop mode")
     parser.add_argument("-b","--blocks",nargs="*",help="Block parameters for blocks mode, in the form 'identifier start end fade', read documentation for more information")
+    parser.add_argument("--target",help="Target for target mode: a wav file whose features the grains should follow, or a curve file with lines of 'time f1 f2 .. fn'")
+    parser.add_argument("--targetk",type=int,default=4,help="Number of nearest grains to pick from for each slot in target mode")
+    parser.add_argument("--targetspread",type=float,default=0.02,help="How far each stream strays from the target, in normalised feature units, target mode only")
+    parser.add_argument("--density",type=float,default=500.,help="Grains per second in cloud mode")
+    parser.add_argument("--duration",type=float,default=10.,help="Length of the output in seconds in cloud mode")
+    parser.add_argument("--grainlengths",type=int,nargs=2,metavar=("MIN","MAX"),help="Range of grain lengths in ms in cloud mode, at most the grain size (default: the grain size)")
     parser.add_argument("-e","--emptiness",type=float,default=0.2,help="Introduces an element of sparseness, block mode only, read documentation for more information")
     parser.add_argument("-x","--effects",nargs="*",help="Effect parameters, in the form 'lowpass/highpass/convolve identifier cutoff transition_bandwidth attenuation, read documentation for more information")
     parser.add_argument("-t","--compthresh",type=float,default=0.2,help="Threshold for compression, specifies a percentage that should be compressed at the top of the dynamic range, e.g. 0.1 compresses top 10 percent")
     parser.add_argument("-a","--compratio",type=float,default=2.5,help="Compression ratio")
+    parser.add_argument("--compmode",choices=["window","envelope"],default="window",help="Compression mode: window applies one gain per window, envelope smooths the gain with an attack/release envelope follower")
+    parser.add_argument("--attack",type=float,default=5.,help="Compressor attack time in ms, envelope mode only")
+    parser.add_argument("--release",type=float,default=100.,help="Compressor release time in ms, envelope mode only")
+    parser.add_argument("--panlaw",choices=["linear","constant"],default="linear",help="Pan law: linear keeps centred grains at full level in both channels, constant keeps every grain at constant power")
     parser.add_argument("-n","--normlevel",type=float,default=0.9,help="Level to normalise to")
     parser.add_argument("-d","--fadesize",type=float,default=0.05,help="Size of the fade in and fade out, corresponds to the alpha value of a Tukey window")
+    parser.add_argument("--dtype",choices=["float32","float64"],default="float32",help="Floating point type audio is processed in, float64 is more precise but uses twice the memory")
+    parser.add_argument("--stats",help="File to write run stats (counts, stage timings, peak memory, throughput) to, as JSON")
+    parser.add_argument("--profile",choices=["cprofile","sample"],help="Profile the render: cprofile times every function call (slow), sample samples the stack now and then (cheap)")
+    parser.add_argument("--profileout",default="iota-profile",help="Prefix of the profile files, a text report (.txt) and collapsed stacks for flame graphs (.folded)")
+    parser.add_argument("--profileinterval",type=float,default=5.,help="Milliseconds of CPU time between samples in sample profiling mode")
     parser.add_argument("-u","--debug",choices=['0','1','2'],default=0,help="Debug level: 0 is off, 1 outputs some text, 2 outputs text and plots some useful graphs")
     
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+    if args.seed != None and args.seed >= 0:
+        np.random.seed(args.seed) # before any random effect parameters are picked below
     infile = args.infile
     outfile = args.outfile
     grainsize = args.grainsize
@@ -92,8 +139,8 @@ def parse_args():
     emptiness = args.emptiness
     debug = int(args.debug)
 
-    if infile == None:
-        parser_error('No input file specified')
+    if infile == None and args.corpus == None:
+        parser_error('No input file or corpus specified')
     if outfile == None:
         parser_error('No output file specified')
     if grainsize < 1:
@@ -110,12 +157,30 @@ def parse_args():
         parser_error("Compression threshold must be between 0 and 1")
     if comp_ratio <= 0.:
         parser_error("Compression ratio must be at least 0.")
+    if args.attack < 0. or args.release < 0.:
+        parser_error("Attack and release times cannot be negative")
     if norm_level <= 0. or norm_level >= 1.0:
         parser_error("Normalisation level must be more than 0 and less than 1")
     if fade_size < 0. or fade_size > 1.0:
         parser_error("Fade size must be between 0 and 1")
     if emptiness < 0.:
         parser_error("Emptiness cannot be less than 0.0")
+    if args.clusteriters < 1:
+        parser_error("Number of clustering iterations must be at least 1")
+    if args.clusterbatch < 1:
+        parser_error("Clustering batch size must be at least 1")
+    if args.workers < 1:
+        parser_error("Number of workers must be at least 1")
+    if args.seed != None and args.seed < 0:
+        parser_error("Seed cannot be negative")
+    if args.cachesize <= 0.:
+        parser_error("Cache size must be more than 0 MB")
+    if args.profileinterval <= 0.:
+        parser_error("Profiling interval must be more than 0 ms")
+    workers = args.workers
+    if args.profile != None and workers > 1:
+        print "Warning: profiling only covers one process. Number of workers reduced from %d to 1." % workers
+        workers = 1
         
     if mode == "loop":
         if args.numloops < 1:
@@ -123,6 +188,23 @@ def parse_args():
         if looplength < grainsize:
             parser_error("loop length must be at least one grain long (%.4f seconds)" % (grainsize/1000.))
         modevars = [args.numloops,int(looplength/grainsize)]
+    elif mode == "target":
+        if args.target == None:
+            parser_error("target mode needs a --target file")
+        if args.targetk < 1:
+            parser_error("number of nearest grains must be at least 1")
+        if args.targetspread < 0.:
+            parser_error("target spread cannot be negative")
+        modevars = [args.target,args.targetk,args.targetspread]
+    elif mode == "cloud":
+        if args.density <= 0.:
+            parser_error("cloud density must be more than 0 grains per second")
+        if args.duration <= 0.:
+            parser_error("cloud duration must be more than 0 seconds")
+        lengths = [grainsize,grainsize] if args.grainlengths == None else args.grainlengths
+        if lengths[0] < 1 or lengths[1] < lengths[0] or lengths[1] > grainsize:
+            parser_error("grain lengths must be from 1ms up to the grain size, shortest first")
+        modevars = [args.density,args.duration,lengths[0],lengths[1]]
     elif mode =="block":
         blocks = args.blocks
         if blocks == None or len(blocks)%4 != 0:
@@ -208,6 +290,6 @@ def parse_args():
             print "Warning: %d unique identifiers entered in effects list. Number of clustering features increased from %d to %d to accommodate." % (len(unique_identifiers),numfeatures,len(unique_identifiers))
             numfeatures = len(unique_identifiers)
             
-    params = parameters(infile,outfile,grainsize,grainspacing,numstreams,numgroups,numfeatures,dzc,mode,modevars,fx,comp_thresh,comp_ratio,norm_level,fade_size,emptiness,debug)
+    params = parameters(infile,outfile,grainsize,grainspacing,numstreams,numgroups,numfeatures,dzc,mode,modevars,fx,comp_thresh,comp_ratio,norm_level,fade_size,emptiness,debug,args.onsets,args.cachedir,int(args.cachesize*(1<<20)),workers,args.seed,args.tempdir,args.compmode,args.attack,args.release,args.clusterer,args.clusteriters,args.clusterbatch,args.stats,args.profile,args.profileout,args.profileinterval,args.dtype,args.corpus,args.panlaw)
     return params
     
\ No newline at end of file
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+
+from collections import OrderedDict
+import cProfile
+import pstats
+import signal
+import os
+
+# ---------------
+# frame_name
+# How a function shows up in the reports: name (file:line).
+# ---------------
+def frame_name(code):
+    return "%s (%s:%d)" % (code.co_name,os.path.basename(code.co_filename),code.co_firstlineno)
+
+# ---------------
+# profiler
+# Profiles a run and attributes the time to the pipeline stages timed by stats.stats, by being
+# one of its hooks. Time outside any stage goes to 'other'.
+# Mode 'cprofile' profiles every function call, with one profile per stage. It's exact but slows the run
+# down a lot. Mode 'sample' instead samples the stack every interval seconds of CPU time, which costs
+# little enough to leave on for normal renders.
+# Only this process is profiled, not pool workers.
+# ---------------
+class profiler:
+    def __init__(self,mode='sample',interval=0.005):
+        self.mode = mode
+        self.interval = interval
+        self.stage_stack = ['other']
+        self.profiles = OrderedDict()
+        self.samples = {}
+        self.running = False
+
+    # ---------------
+    # hook
+    # stats hook: follows the stages as they start and finish.
+    # ---------------
+    def hook(self,name,record):
+        if name == 'run':
+            return
+        if record == None:
+            self.switch(self.stage_stack+[name])
+        elif len(self.stage_stack) > 1 and self.stage_stack[-1] == name:
+            self.switch(self.stage_stack[:-1])
+
+    # ---------------
+    # switch
+    # Changes the current stage. With cProfile this means swapping which stage's profile is enabled.
+    # ---------------
+    def switch(self,stage_stack):
+        if self.mode == 'cprofile' and self.running:
+            self.profile(self.stage_stack[-1]).disable()
+            self.stage_stack = stage_stack
+            self.profile(self.stage_stack[-1]).enable()
+        else:
+            self.stage_stack = stage_stack
+
+    def profile(self,stage):
+        if not stage in self.profiles:
+            self.profiles[stage] = cProfile.Profile()
+        return self.profiles[stage]
+
+    # ---------------
+    # sample
+    # SIGPROF handler: records the stack the signal interrupted under the current stage.
+    # ---------------
+    def sample(self,signum,frame):
+        stack = []
+        while frame != None:
+            stack.append(frame_name(frame.f_code))
+            frame = frame.f_back
+        key = (self.stage_stack[-1],tuple(reversed(stack)))
+        self.samples[key] = self.samples.get(key,0)+1
+
+    def start(self):
+        self.running = True
+        if self.mode == 'cprofile':
+            self.profile(self.stage_stack[-1]).enable()
+        else:
+            signal.signal(signal.SIGPROF,self.sample)
+            signal.setitimer(signal.ITIMER_PROF,self.interval,self.interval)
+
+    def stop(self):
+        if self.mode == 'cprofile':
+            self.profile(self.stage_stack[-1]).disable()
+        else:
+            signal.setitimer(signal.ITIMER_PROF,0)
+            signal.signal(signal.SIGPROF,signal.SIG_DFL)
+        self.running = False
+
+    # ---------------
+    # write
+    # Writes the report to prefix.txt and the collapsed stacks (one 'stage;outer;...;inner count'
+    # line per stack, as flamegraph.pl and speedscope read them) to prefix.folded.
+    # ---------------
+    def write(self,prefix,limit=30):
+        if self.mode == 'cprofile':
+            [report,folded] = self.cprofile_report(limit)
+        else:
+            [report,folded] = self.sample_report(limit)
+        with open(prefix+".txt",'w') as f:
+            f.write(report)
+        with open(prefix+".folded",'w') as f:
+            f.write("".join(["%s %d\n" % (stack,count) for stack,count in sorted(folded.items()) if count > 0]))
+        print "Profile written to %s.txt and %s.folded.." % (prefix,prefix)
+
+    # ---------------
+    # cprofile_report
+    # Per stage, the functions sorted by cumulative time. cProfile only keeps caller/callee pairs,
+    # so the collapsed stacks are two functions deep, weighted by microseconds.
+    # ---------------
+    def cprofile_report(self,limit):
+        import StringIO
+        out = StringIO.StringIO()
+        folded = {}
+        for stage,profile in self.profiles.items():
+            s = pstats.Stats(profile,stream=out)
+            if s.total_tt <= 0.:
+                continue
+            out.write("=== stage %s: %.3fs ===\n" % (stage,s.total_tt))
+            s.sort_stats('cumulative').print_stats(limit)
+            for (filename,line,name),(cc,nc,tt,ct,callers) in s.stats.items():
+                callee = "%s (%s:%d)" % (name,os.path.basename(filename),line)
+                if len(callers) == 0:
+                    folded["%s;%s" % (stage,callee)] = folded.get("%s;%s" % (stage,callee),0)+int(tt*1e6)
+                for (_filename,_line,_name),caller_stats in callers.items():
+                    key = "%s;%s (%s:%d);%s" % (stage,_name,os.path.basename(_filename),_line,callee)
+                    folded[key] = folded.get(key,0)+int(caller_stats[2]*1e6)
+        return [out.getvalue(),folded]
+
+    # ---------------
+    # sample_report
+    # Samples per stage, then the functions with the most samples, by their own time
+    # (at the top of the stack) and in total (anywhere on the stack).
+    # ---------------
+    def sample_report(self,limit):
+        total = sum(self.samples.values())
+        stages,own,inclusive,folded = {},{},{},{}
+        for (stage,stack),count in self.samples.items():
+            stages[stage] = stages.get(stage,0)+count
+            own[stack[-1]] = own.get(stack[-1],0)+count
+            for name in set(stack):
+                inclusive[name] = inclusive.get(name,0)+count
+            key = ";".join((stage,)+stack)
+            folded[key] = folded.get(key,0)+count
+        lines = ["%d samples, one per %.1fms of CPU time" % (total,self.interval*1000.),"","Stages:"]
+        percent = lambda count: 100.*count/max(total,1)
+        for stage,count in sorted(stages.items(),key=lambda x: -x[1]):
+            lines.append("  %6.1f%%  %s" % (percent(count),stage))
+        for title,counts in [("Own time:",own),("Total time:",inclusive)]:
+            lines += ["",title]
+            for name,count in sorted(counts.items(),key=lambda x: -x[1])[:limit]:
+                lines.append("  %6.1f%%  %s" % (percent(count),name))
+        return ["\n".join(lines)+"\n",folded]
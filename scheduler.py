@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+
+import numpy as np
+import audio as au
+import stats as st
+
+batch_samples = 1<<20 # roughly how many grain samples are rendered at once, and how much output a batch covers
+
+# ---------------
+# eventtable
+# A table of grain events: where each starts in the output (in samples), which grain of the bank
+# it plays, its gain, its pan (-1 is left, 1 is right, as in grainstream) and how many samples of
+# the grain it plays, up to the bank's grain size. Events can be given in any order and overlap
+# any amount, they're kept sorted by onset.
+# ---------------
+class eventtable:
+    def __init__(self,onsets,grains,gains,pans,lengths):
+        order = np.argsort(onsets,kind='mergesort')
+        self.onsets = np.asarray(onsets,dtype=np.int64)[order]
+        self.grains = np.asarray(grains,dtype=int)[order]
+        self.gains = np.asarray(gains,dtype=float)[order]
+        self.pans = np.asarray(pans,dtype=float)[order]
+        self.lengths = np.asarray(lengths,dtype=np.int64)[order]
+
+    def __len__(self):
+        return len(self.onsets)
+
+    # ---------------
+    # end
+    # Returns the sample after the last event ends.
+    # ---------------
+    def end(self):
+        if len(self) == 0:
+            return 0
+        return int(np.amax(self.onsets+self.lengths))
+
+# ---------------
+# tukey_rows
+# A tukey window for every length in lengths, one per row of grain_size samples and zero past
+# each window's length. Each row is the same as audio.tukey(length,alpha).
+# ---------------
+def tukey_rows(lengths,grain_size,alpha=0.1):
+    t = np.arange(0,grain_size)
+    lengths = lengths[:,np.newaxis]
+    x = t/np.maximum(lengths-1.,1.)
+    x[t == lengths-1] = 1.
+    window = np.ones(x.shape)
+    fade_in = x < alpha/2
+    window[fade_in] = 0.5*(1+np.cos(2*np.pi/alpha*(x[fade_in]-alpha/2)))
+    fade_out = x >= (1-alpha/2)
+    window[fade_out] = 0.5*(1+np.cos(2*np.pi/alpha*(x[fade_out]-1+alpha/2)))
+    window[t >= lengths] = 0.
+    return window
+
+# ---------------
+# render
+# Renders every event of a table from a grain bank into the stereo buffer out, which has to be
+# at least table.end() samples long. Events are done in batches of neighbouring onsets: the batch's
+# grains are gathered and windowed as one matrix, and each channel is overlap-added with a single
+# scatter-add (np.bincount over output positions) into the stretch of output the batch covers.
+# A batch ends after batch_samples/grain_size events or once its onsets span batch_samples, so
+# neither the grains nor the stretch of output a batch works on grow with the cloud, dense or sparse.
+# pan_law is as for audio.pan_gains.
+# ---------------
+def render(table,bank,out,stats=None,pan_law='linear'):
+    grain_size = bank.grain_size
+    t = np.arange(0,grain_size)
+    batch = max(1,batch_samples/grain_size)
+    full = au.tukey(grain_size,0.1)
+    with st.stage(stats,'render'):
+        i = 0
+        while i < len(table):
+            j = min(i+batch,max(i+1,np.searchsorted(table.onsets,table.onsets[i]+batch_samples)))
+            onsets,lengths = table.onsets[i:j],table.lengths[i:j]
+            grains = au.materialise(bank.frames[bank.offsets[table.grains[i:j]]],out.dtype)
+            if np.all(lengths == grain_size):
+                grains *= full
+            else:
+                grains *= tukey_rows(lengths,grain_size)
+            grains *= table.gains[i:j,np.newaxis]
+            inside = t < lengths[:,np.newaxis]
+            start = int(onsets[0])
+            span = int(np.amax(onsets+lengths))-start
+            positions = (onsets[:,np.newaxis]-start+t)[inside]
+            for channel,gains in enumerate(au.pan_gains(table.pans[i:j],pan_law)):
+                out[channel,start:start+span] += np.bincount(positions,(grains*gains[:,np.newaxis])[inside],span)
+            i = j
+    if stats != None:
+        stats.num_grains += len(table)
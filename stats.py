@@ -1,12 +1,140 @@
 #!/usr/bin/env python
 
+from collections import OrderedDict
+from contextlib import contextmanager
+import resource
+import json
+import time
+
+# ---------------
+# usage
+# Returns [cpu seconds,peak rss in MB] for this process so far.
+# ---------------
+def usage():
+    ru = resource.getrusage(resource.RUSAGE_SELF)
+    return [ru.ru_utime+ru.ru_stime,ru.ru_maxrss/1024.] # ru_maxrss is in KB on Linux
+
 # ---------------
 # stats
 # Just a little structure to store some global run statistics.
+# Besides the counters, it times the stages of a run (wall and CPU time, and peak RSS by the end
+# of the stage) and calls any hooks each time a stage starts or finishes and when the run is finished.
+# A hook is called as hook(name,record), where record is None when a stage starts, the stage's
+# figures when it finishes, or the whole summary when name is 'run'.
 # ---------------
 class stats:
-    def __init__(self):
+    def __init__(self,hooks=None):
         self.convolutions = 0
         self.filterings = 0
         self.num_grains = 0
-        self.num_events = 0
\ No newline at end of file
+        self.num_events = 0
+        self.sample_rate = 0
+        self.output_length = 0 # samples
+        self.stages = OrderedDict()
+        self.hooks = [] if hooks == None else list(hooks)
+        self.started = time.time()
+        self.wall = None
+
+    # ---------------
+    # stage
+    # Context manager timing a stage. A stage can be entered several times and its figures add up,
+    # and stages can be nested (e.g. clustering is part of analysis).
+    # ---------------
+    @contextmanager
+    def stage(self,name):
+        for hook in self.hooks:
+            hook(name,None)
+        start_wall = time.time()
+        start_cpu = usage()[0]
+        try:
+            yield
+        finally:
+            [cpu,rss] = usage()
+            record = self.stages.setdefault(name,{'wall':0.,'cpu':0.,'calls':0,'peak_rss_mb':0.})
+            record['wall'] += time.time()-start_wall
+            record['cpu'] += cpu-start_cpu
+            record['calls'] += 1
+            record['peak_rss_mb'] = max(record['peak_rss_mb'],rss)
+            for hook in self.hooks:
+                hook(name,record)
+
+    # ---------------
+    # add
+    # Adds the counts and stage figures from another stats structure (e.g. one from a worker process).
+    # Stage times add up across processes, so they give the total work done rather than elapsed time.
+    # ---------------
+    def add(self,other):
+        self.convolutions += other.convolutions
+        self.filterings += other.filterings
+        self.num_grains += other.num_grains
+        for name,theirs in other.stages.items():
+            record = self.stages.setdefault(name,{'wall':0.,'cpu':0.,'calls':0,'peak_rss_mb':0.})
+            record['wall'] += theirs['wall']
+            record['cpu'] += theirs['cpu']
+            record['calls'] += theirs['calls']
+            record['peak_rss_mb'] = max(record['peak_rss_mb'],theirs['peak_rss_mb'])
+
+    # ---------------
+    # finish
+    # Marks the end of the run and passes the summary to the hooks.
+    # ---------------
+    def finish(self):
+        self.wall = time.time()-self.started
+        summary = self.summary()
+        for hook in self.hooks:
+            hook('run',summary)
+        return summary
+
+    # ---------------
+    # summary
+    # All the figures of the run, as a dictionary that can be turned straight into JSON.
+    # ---------------
+    def summary(self):
+        wall = self.wall if self.wall != None else time.time()-self.started
+        output_seconds = float(self.output_length)/self.sample_rate if self.sample_rate > 0 else 0.
+        generation = self.stages.get('generation',{'wall':0.})['wall']
+        return {'convolutions':self.convolutions,'filterings':self.filterings,
+            'num_grains':self.num_grains,'num_events':self.num_events,
+            'wall':wall,'cpu':usage()[0],'peak_rss_mb':usage()[1],
+            'output_seconds':output_seconds,
+            'grains_per_second':self.num_grains/generation if generation > 0. else 0.,
+            'realtime_factor':output_seconds/wall if wall > 0. else 0.,
+            'stages':self.stages}
+
+    # ---------------
+    # write_json
+    # Writes the summary of the run to a file.
+    # ---------------
+    def write_json(self,filename):
+        with open(filename,'w') as f:
+            json.dump(self.summary(),f,indent=2)
+
+    # ---------------
+    # report
+    # Prints the summary of the run in a readable form.
+    # ---------------
+    def report(self):
+        s = self.summary()
+        print "Run stats:"
+        print "  Number of events: %d" % self.num_events
+        print "  Number of grains: %d" % self.num_grains
+        print "  Number of effect convolutions: %d" % self.convolutions
+        print "  Number of filter uses: %d" % self.filterings
+        print "  Grains per second: %.0f" % s['grains_per_second']
+        print "  Realtime factor: %.2fx (%.2fs of audio in %.2fs)" % (s['realtime_factor'],s['output_seconds'],s['wall'])
+        print "  Peak RSS: %.1f MB" % s['peak_rss_mb']
+        print "  Stages:"
+        for name,record in self.stages.items():
+            print "    %-12s %8.3fs wall %8.3fs cpu %8.1f MB peak rss" % (name,record['wall'],record['cpu'],record['peak_rss_mb'])
+
+# ---------------
+# stage
+# stats.stage for an optional stats structure, timing nothing if there isn't one.
+# ---------------
+@contextmanager
+def stage(_stats,name):
+    if _stats == None:
+        yield
+    else:
+        with _stats.stage(name):
+            yield